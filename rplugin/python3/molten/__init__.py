@@ -1,10 +1,13 @@
 import json
 import os
+import time
 from typing import Any, Dict, List, Optional, Tuple
 from itertools import chain
 
 import pynvim
 from pynvim.api import Buffer
+from molten.ansi import redefine_ansi_groups
+from molten.cell_index import SpanIndex
 from molten.code_cell import CodeCell
 from molten.images import Canvas, get_canvas_given_provider, WeztermCanvas
 from molten.info_window import create_info_window
@@ -13,7 +16,8 @@ from molten.save_load import MoltenIOError, get_default_save_file, load, save
 from molten.moltenbuffer import MoltenKernel
 from molten.options import MoltenOptions
 from molten.outputbuffer import OutputBuffer
-from molten.position import DynamicPosition, Position
+from molten.position import DynamicPosition, Position, position_snapshot
+from molten.render import RenderScheduler
 from molten.runtime import get_available_kernels
 from molten.utils import MoltenException, notify_error, notify_info, notify_warn, nvimui
 from molten.outline import MagicCellOutlineParser, OutlineRenderer, VerticalOutlineRenderer
@@ -27,11 +31,13 @@ class Molten:
 
     Invariants that must be maintained in order for this plugin to work:
     - Any CodeCell which belongs to some MoltenKernel _a_ never overlaps with any CodeCell which
-      belongs to some MoltenKernel _b_.
+      belongs to some MoltenKernel _b_. `span_index` finds the cells a new one would overlap.
     """
 
     nvim: Nvim
     canvas: Optional[Canvas]
+    render_scheduler: Optional[RenderScheduler]
+    span_index: SpanIndex
     initialized: bool
 
     highlight_namespace: int
@@ -56,10 +62,12 @@ class Molten:
         self.initialized = False
 
         self.canvas = None
+        self.render_scheduler = None
         self.buffers = {}
         self.timer = None
         self.input_timer = None
         self.molten_kernels = {}
+        self.span_index = SpanIndex(nvim, lambda bufno: self.buffers.get(bufno, []))
         
         # 初始化outline组件
         self.outline_parser = MagicCellOutlineParser()
@@ -74,12 +82,20 @@ class Molten:
         self.canvas = get_canvas_given_provider(self.nvim, self.options)
         self.canvas.init()
 
+        self.render_scheduler = RenderScheduler(self.nvim, self.options)
+
         self.highlight_namespace = self.nvim.funcs.nvim_create_namespace("molten-highlights")
         self.extmark_namespace = self.nvim.funcs.nvim_create_namespace("molten-extmarks")
 
-        self.timer = self.nvim.eval(
-            f"timer_start({self.options.tick_rate}, 'MoltenTick', {{'repeat': -1}})"
-        )  # type: ignore
+        # with push delivery kernels ask to be ticked when they have messages, no need to poll
+        if self.options.iopub_delivery == "push" or self.options.async_runtime:
+            pass
+        elif self.options.adaptive_tick:
+            self._schedule_tick()
+        else:
+            self.timer = self.nvim.eval(
+                f"timer_start({self.options.tick_rate}, 'MoltenTick', {{'repeat': -1}})"
+            )  # type: ignore
 
         self.input_timer = self.nvim.eval(
             f"timer_start({self.options.tick_rate}, 'MoltenTickInput', {{'repeat': -1}})"
@@ -103,6 +119,7 @@ class Molten:
         self.nvim.command("autocmd BufLeave     * call MoltenBufLeave()")
         self.nvim.command("autocmd BufUnload    * call MoltenOnBufferUnload()")
         self.nvim.command("autocmd ExitPre      * call MoltenOnExitPre()")
+        self.nvim.command("autocmd ColorScheme  * call MoltenOnColorScheme()")
         self.nvim.command("augroup END")
 
     def _setup_highlights(self) -> None:
@@ -116,11 +133,33 @@ class Molten:
                 molten_kernel.deinit()
         if self.canvas is not None:
             self.canvas.deinit()
+        if self.render_scheduler is not None:
+            self.render_scheduler.deinit()
         if self.timer is not None:
             self.nvim.funcs.timer_stop(self.timer)
         if self.input_timer is not None:
             self.nvim.funcs.timer_stop(self.input_timer)
 
+    def _schedule_tick(self) -> None:
+        """Re-arm the one shot MoltenTick timer for whichever kernel is due first. Only used with
+        `adaptive_tick`, where every kernel picks its own delay between ticks"""
+        if (
+            not self.options.adaptive_tick
+            or self.options.iopub_delivery == "push"
+            or self.options.async_runtime
+        ):
+            return
+
+        if self.molten_kernels:
+            delay = min(k.next_tick for k in self.molten_kernels.values()) - time.monotonic()
+            delay = max(0, int(delay * 1000))
+        else:
+            delay = self.options.tick_rate_max
+
+        if self.timer is not None:
+            self.nvim.funcs.timer_stop(self.timer)
+        self.timer = self.nvim.funcs.timer_start(delay, "MoltenTick")
+
     def _initialize_if_necessary(self) -> None:
         if not self.initialized:
             self._initialize()
@@ -153,6 +192,7 @@ class Molten:
                 molten_kernel.clear_virt_outputs()
         self._clear_on_buf_leave()
 
+    @position_snapshot()
     def _update_interface(self) -> None:
         """Called on load, show_output/hide_output and buf enter"""
         if not self.initialized:
@@ -165,6 +205,7 @@ class Molten:
         for m in molten_kernels:
             m.update_interface()
 
+    @position_snapshot()
     def _on_cursor_moved(self, scrolled=False) -> None:
         if not self.initialized:
             return
@@ -178,6 +219,7 @@ class Molten:
 
     def _initialize_buffer(self, kernel_name: str, shared=False) -> MoltenKernel | None:
         assert self.canvas is not None
+        assert self.render_scheduler is not None
         if shared:  # use an existing molten kernel, for a new neovim buffer
             molten = self.molten_kernels.get(kernel_name)
             if molten is not None:
@@ -198,6 +240,8 @@ class Molten:
             molten = MoltenKernel(
                 self.nvim,
                 self.canvas,
+                self.render_scheduler,
+                self.span_index,
                 self.highlight_namespace,
                 self.extmark_namespace,
                 self.nvim.current.buffer,
@@ -228,6 +272,7 @@ class Molten:
             self.buffers[buffer.number].append(kernel)
 
         self.molten_kernels[kernel_id] = kernel
+        self._schedule_tick()
 
     @pynvim.command("MoltenInit", nargs="*", sync=True, complete="file")  # type: ignore
     @nvimui  # type: ignore
@@ -268,6 +313,7 @@ class Molten:
                 self.buffers[buf.number].remove(kernel)
                 if len(self.buffers[buf.number]) == 0:
                     del self.buffers[buf.number]
+                    self.span_index.forget(buf.number)
             del self.molten_kernels[kernel.kernel_id]
 
     def _do_evaluate_expr(self, kernel_name: str, expr):
@@ -292,6 +338,7 @@ class Molten:
         )
 
         kernel.run_code(expr, cell)
+        self._schedule_tick()
 
     def _get_sorted_buf_cells(self, kernels: List[MoltenKernel], bufnr: int) -> List[CodeCell]:
         return sorted([x for x in chain(*[k.outputs.keys() for k in kernels]) if x.bufno == bufnr])
@@ -367,6 +414,7 @@ class Molten:
     def command_info(self) -> None:
         create_info_window(self.nvim, self.molten_kernels, self.buffers, self.initialized)
 
+    @position_snapshot()
     def _do_evaluate(self, kernel_name: str, pos: Tuple[Tuple[int, int], Tuple[int, int]]) -> None:
         self._initialize_if_necessary()
 
@@ -392,12 +440,12 @@ class Molten:
 
         # delete overlapping cells from other kernels. Maintains the invariant that all code cells
         # from different kernels are disjoint
-        for k in kernels:
-            if k.kernel_id != kernel.kernel_id:
-                if not k.try_delete_overlapping_cells(span):
-                    return
+        for cell, owner in self.span_index.get(bufno).overlapping(span):
+            if owner is not kernel and not owner._delete_cell(cell):
+                return
 
         kernel.run_code(code, span)
+        self._schedule_tick()
 
     @pynvim.function("MoltenUpdateOption", sync=True)  # type: ignore
     @nvimui  # type: ignore
@@ -414,11 +462,13 @@ class Molten:
             )
 
     @pynvim.function("MoltenAvailableKernels", sync=True)  # type: ignore
+    @nvimui  # type: ignore
     def function_available_kernels(self, _):
         """List of string kernel names that molten knows about"""
         return get_available_kernels()
 
     @pynvim.function("MoltenRunningKernels", sync=True)  # type: ignore
+    @nvimui  # type: ignore
     def function_list_running_kernels(self, args: List[Optional[bool]]) -> List[str]:
         """List all the running kernels. When passed [True], returns only buf local kernels"""
         if not self.initialized:
@@ -431,11 +481,13 @@ class Molten:
         return list(self.molten_kernels.keys())
 
     @pynvim.function("MoltenStatusLineKernels", sync=True)  # type: ignore
+    @nvimui  # type: ignore
     def function_status_line_kernels(self, args) -> str:
         kernels = self.function_list_running_kernels(args)
         return " ".join(kernels)
 
     @pynvim.function("MoltenStatusLineInit", sync=True)  # type: ignore
+    @nvimui  # type: ignore
     def function_status_line_init(self, _) -> str:
         if self.initialized:
             return "Molten"
@@ -443,6 +495,7 @@ class Molten:
 
     @pynvim.command("MoltenNext", sync=True, nargs="*")  # type: ignore
     @nvimui
+    @position_snapshot()
     def command_next(self, args: List[str]) -> None:
         count = 1
         if len(args) > 0:
@@ -485,6 +538,7 @@ class Molten:
 
     @pynvim.command("MoltenGoto", sync=True, nargs="*")  # type: ignore
     @nvimui
+    @position_snapshot()
     def command_goto(self, args: List[str]) -> None:
         count = 1
         if len(args) > 0:
@@ -506,6 +560,7 @@ class Molten:
 
     @pynvim.command("MoltenPrev", sync=True, nargs="*")  # type: ignore
     @nvimui
+    @position_snapshot()
     def command_prev(self, args: List[str]) -> None:
         count = -1
         if len(args) > 0:
@@ -1086,15 +1141,18 @@ class Molten:
 
     @pynvim.command("MoltenReevaluateAll", nargs=0, sync=True)  # type: ignore
     @nvimui  # type: ignore
+    @position_snapshot()
     def command_reevaluate_all(self) -> None:
         molten_kernels = self._get_current_buf_kernels(True)
         assert molten_kernels is not None
 
         for kernel in molten_kernels:
             kernel.reevaluate_all()
+        self._schedule_tick()
 
     @pynvim.command("MoltenReevaluateCell", nargs=0, sync=True)  # type: ignore
     @nvimui  # type: ignore
+    @position_snapshot()
     def command_evaluate_cell(self) -> None:
         molten_kernels = self._get_current_buf_kernels(True)
         assert molten_kernels is not None
@@ -1104,6 +1162,7 @@ class Molten:
         for kernel in molten_kernels:
             if kernel.reevaluate_cell():
                 in_cell = True
+        self._schedule_tick()
 
         if not in_cell:
             notify_error(self.nvim, "Not in a cell")
@@ -1123,6 +1182,7 @@ class Molten:
         for molten in molten_kernels:
             if molten.kernel_id == kernel:
                 molten.interrupt()
+                self._schedule_tick()
                 return
 
         notify_error(self.nvim, f"Unable to find kernel: {kernel}")
@@ -1142,6 +1202,7 @@ class Molten:
         for molten in molten_kernels:
             if molten.kernel_id == kernel:
                 molten.restart(delete_outputs=bang)
+                self._schedule_tick()
                 return
         notify_error(self.nvim, f"Unable to find kernel: {kernel}")
 
@@ -1352,17 +1413,50 @@ class Molten:
     def function_on_exit_pre(self, _: Any) -> None:
         self._deinitialize()
 
+    @pynvim.function("MoltenOnColorScheme", sync=False)  # type: ignore
+    @nvimui  # type: ignore
+    def function_on_colorscheme(self, _: Any) -> None:
+        redefine_ansi_groups(self.nvim)
+
     @pynvim.function("MoltenTick", sync=True)  # type: ignore
     @nvimui  # type: ignore
+    @position_snapshot()
     def function_molten_tick(self, _: Any) -> None:
         self._initialize_if_necessary()
 
-        molten_kernels = self._get_current_buf_kernels(False)
-        if molten_kernels is None:
+        # Every kernel is ticked, not only the ones attached to the current buffer, so output of
+        # kernels in hidden buffers keeps being drained into their Output objects. Rendering is
+        # skipped by the kernel until one of its buffers is visible again.
+        now = time.monotonic()
+        try:
+            for m in self.molten_kernels.values():
+                if not self.options.adaptive_tick or m.next_tick <= now:
+                    m.tick()
+        finally:
+            # the adaptive timer is one shot, a failing kernel mustn't stop every kernel's polling
+            self._schedule_tick()
+
+    @pynvim.function("MoltenTickKernel", sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    @position_snapshot()
+    def function_molten_tick_kernel(self, args: List[str]) -> None:
+        """Tick a single kernel, requested by its iopub reader when messages arrive"""
+        if not self.initialized or len(args) == 0:
             return
 
-        for m in molten_kernels:
-            m.tick()
+        molten_kernel = self.molten_kernels.get(args[0])
+        if molten_kernel is None:
+            return
+
+        molten_kernel.tick()
+
+    @pynvim.function("MoltenRenderFrame", sync=True)  # type: ignore
+    @nvimui  # type: ignore
+    @position_snapshot()
+    def function_molten_render_frame(self, _: Any) -> None:
+        """Draw the kernels that were marked dirty during the last frame"""
+        if self.render_scheduler is not None:
+            self.render_scheduler.flush()
 
     @pynvim.function("MoltenTickInput", sync=False)  # type: ignore
     @nvimui  # type: ignore
@@ -1433,6 +1527,7 @@ class Molten:
         )
 
     @pynvim.function("MoltenDefineCell", sync=True)
+    @nvimui
     def function_molten_define_cell(self, args: List[int]) -> None:
         if not args:
             return
@@ -0,0 +1,248 @@
+import re
+from itertools import chain
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from pynvim import Nvim
+
+from molten.batch import RpcBatch
+
+# Adapted from [https://stackoverflow.com/a/14693789/4803382]:
+ANSI_CODE_REGEX = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+
+Color = Union[int, str]
+"""an index in the 256 color palette, or "#rrggbb" for 24 bit colors"""
+
+
+class Style(NamedTuple):
+    """What SGR escape sequences ("\\x1b[1;31m") have set, the text that follows is shown like
+    this"""
+
+    fg: Optional[Color] = None
+    bg: Optional[Color] = None
+    bold: bool = False
+    italic: bool = False
+    underline: bool = False
+    strikethrough: bool = False
+    reverse: bool = False
+
+
+DEFAULT_STYLE = Style()
+
+Span = Tuple[int, int, Style]
+"""start and end offsets of some text, and its style"""
+
+# fmt: off
+BASIC_COLORS = [
+    "#000000", "#cd0000", "#00cd00", "#cdcd00", "#0000ee", "#cd00cd", "#00cdcd", "#e5e5e5",
+    "#7f7f7f", "#ff0000", "#00ff00", "#ffff00", "#5c5cff", "#ff00ff", "#00ffff", "#ffffff",
+]
+# fmt: on
+
+# SGR parameters that turn an attribute on or off
+ATTRIBUTES = {
+    1: ("bold", True),
+    3: ("italic", True),
+    4: ("underline", True),
+    7: ("reverse", True),
+    9: ("strikethrough", True),
+    22: ("bold", False),
+    23: ("italic", False),
+    24: ("underline", False),
+    27: ("reverse", False),
+    29: ("strikethrough", False),
+}
+
+
+def _extended_color(params: List[int], i: int) -> Tuple[Optional[Color], int]:
+    """The color of a 38 or 48 parameter at `i`, and the index of the parameter after it"""
+    kind = params[i + 1] if i + 1 < len(params) else None
+    if kind == 5 and i + 2 < len(params):
+        return params[i + 2] % 256, i + 3
+    if kind == 2 and i + 4 < len(params):
+        r, g, b = (min(x, 255) for x in params[i + 2 : i + 5])
+        return f"#{r:02x}{g:02x}{b:02x}", i + 5
+    # malformed, ignore the rest of the sequence
+    return None, len(params)
+
+
+def apply_sgr(style: Style, parameters: str) -> Style:
+    """The style after the SGR escape sequence with these parameters (what's between "\\x1b[" and
+    "m")"""
+    try:
+        params = [int(x) if x != "" else 0 for x in parameters.split(";")]
+    except ValueError:
+        # eg. colon separated sub-parameters, which kernels don't send
+        return style
+
+    i = 0
+    while i < len(params):
+        p = params[i]
+        i += 1
+        if p == 0:
+            style = DEFAULT_STYLE
+        elif p in ATTRIBUTES:
+            name, value = ATTRIBUTES[p]
+            style = style._replace(**{name: value})
+        elif 30 <= p <= 37:
+            style = style._replace(fg=p - 30)
+        elif 90 <= p <= 97:
+            style = style._replace(fg=p - 90 + 8)
+        elif 40 <= p <= 47:
+            style = style._replace(bg=p - 40)
+        elif 100 <= p <= 107:
+            style = style._replace(bg=p - 100 + 8)
+        elif p == 39:
+            style = style._replace(fg=None)
+        elif p == 49:
+            style = style._replace(bg=None)
+        elif p == 38 or p == 48:
+            color, i = _extended_color(params, i - 1)
+            if color is not None:
+                style = style._replace(**{"fg" if p == 38 else "bg": color})
+    return style
+
+
+def parse_ansi(text: str, style: Style = DEFAULT_STYLE) -> Tuple[str, List[Span], Style]:
+    """Remove the escape sequences from `text`, which starts in `style`. Returns the text without
+    them, the spans of it that aren't in the default style, and the style at its end"""
+    if "\x1b" not in text:
+        if style == DEFAULT_STYLE or text == "":
+            return text, [], style
+        return text, [(0, len(text), style)], style
+
+    pieces = []
+    spans: List[Span] = []
+    offset = 0
+    pos = 0
+    for match in chain(ANSI_CODE_REGEX.finditer(text), [None]):
+        # the text up to the next escape sequence, or the end
+        end = match.start() if match is not None else len(text)
+        if end > pos:
+            piece = text[pos:end]
+            pieces.append(piece)
+            if style != DEFAULT_STYLE:
+                if len(spans) > 0 and spans[-1][1] == offset and spans[-1][2] == style:
+                    # only escape sequences that didn't change anything in between
+                    spans[-1] = (spans[-1][0], offset + len(piece), style)
+                else:
+                    spans.append((offset, offset + len(piece), style))
+            offset += len(piece)
+        if match is None:
+            break
+        sequence = match.group()
+        if sequence.startswith("\x1b[") and sequence.endswith("m"):
+            style = apply_sgr(style, sequence[2:-1])
+        pos = match.end()
+
+    return "".join(pieces), spans, style
+
+
+_UNCHANGED: Any = object()
+# what's left untouched by a sequence of escape sequences is still this, see `collapse_sgr`
+UNCHANGED_STYLE = Style(*[_UNCHANGED] * len(Style._fields))
+
+
+def _color_parameters(color: Optional[Color], base: int) -> List[int]:
+    """SGR parameters for a foreground (`base` 30) or background (`base` 40) color"""
+    if color is None:
+        return [base + 9]
+    if isinstance(color, str):
+        return [base + 8, 2, int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)]
+    if color < 8:
+        return [base + color]
+    if color < 16:
+        return [base + 60 + color - 8]
+    return [base + 8, 5, color]
+
+
+def collapse_sgr(text: str) -> str:
+    """A single escape sequence that changes the style like all the SGR sequences in `text` do
+    together, or "" if they don't change anything. Used to keep the style changes of text that's
+    erased, without keeping all of their sequences around"""
+    style = UNCHANGED_STYLE
+    for match in ANSI_CODE_REGEX.finditer(text):
+        sequence = match.group()
+        if sequence.startswith("\x1b[") and sequence.endswith("m"):
+            style = apply_sgr(style, sequence[2:-1])
+
+    params: List[int] = []
+    if style.fg is not _UNCHANGED:
+        params += _color_parameters(style.fg, 30)
+    if style.bg is not _UNCHANGED:
+        params += _color_parameters(style.bg, 40)
+    for on, off in ((1, 22), (3, 23), (4, 24), (9, 29), (7, 27)):
+        value = getattr(style, ATTRIBUTES[on][0])
+        if value is not _UNCHANGED:
+            params.append(on if value else off)
+
+    if len(params) == 0:
+        return ""
+    return f"\x1b[{';'.join(map(str, params))}m"
+
+
+def _palette_color(index: int) -> str:
+    if index < 16:
+        return BASIC_COLORS[index]
+    if index < 232:
+        index -= 16
+        levels = [0] + [55 + 40 * x for x in range(1, 6)]
+        return f"#{levels[index // 36]:02x}{levels[index // 6 % 6]:02x}{levels[index % 6]:02x}"
+    grey = 8 + 10 * (index - 232)
+    return f"#{grey:02x}{grey:02x}{grey:02x}"
+
+
+def _color_name(color: Color) -> str:
+    return str(color) if isinstance(color, int) else color[1:]
+
+
+def highlight_group(style: Style) -> str:
+    name = "MoltenAnsi"
+    if style.fg is not None:
+        name += f"Fg{_color_name(style.fg)}"
+    if style.bg is not None:
+        name += f"Bg{_color_name(style.bg)}"
+    for attribute in ("bold", "italic", "underline", "strikethrough", "reverse"):
+        if getattr(style, attribute):
+            name += attribute.capitalize()
+    return name
+
+
+def highlight_definition(style: Style) -> Dict[str, Any]:
+    """The `nvim_set_hl` attributes of the highlight group for `style`"""
+    definition: Dict[str, Any] = {}
+    for key, color in (("fg", style.fg), ("bg", style.bg)):
+        if isinstance(color, int):
+            definition[key] = _palette_color(color)
+            definition["cterm" + key] = color
+        elif color is not None:
+            definition[key] = color
+    attributes = {
+        attribute: True
+        for attribute in ("bold", "italic", "underline", "strikethrough", "reverse")
+        if getattr(style, attribute)
+    }
+    if len(attributes) > 0:
+        definition.update(attributes)
+        definition["cterm"] = attributes
+    return definition
+
+
+_groups: Dict[Style, str] = {}
+"""the highlight groups defined so far, by the style they're for"""
+
+
+def ansi_group(style: Style, batch: RpcBatch) -> str:
+    """The highlight group for `style`, defining it through `batch` the first time it's used"""
+    group = _groups.get(style)
+    if group is None:
+        group = highlight_group(style)
+        batch.add("nvim_set_hl", 0, group, highlight_definition(style))
+        _groups[style] = group
+    return group
+
+
+def redefine_ansi_groups(nvim: Nvim) -> None:
+    """Define the groups again after loading a colorscheme cleared them"""
+    with RpcBatch(nvim) as batch:
+        for style, group in _groups.items():
+            batch.add("nvim_set_hl", 0, group, highlight_definition(style))
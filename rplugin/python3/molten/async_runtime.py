@@ -0,0 +1,272 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+from queue import Empty as EmptyQueueException
+from queue import Queue
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Coroutine, Dict, Optional
+
+import jupyter_client
+
+from molten.outputchunks import Output
+from molten.runtime import IOPUB_READER_TIMEOUT, JupyterRuntime
+from molten.runtime_state import RuntimeState
+from molten.utils import notify_error
+
+# How long (in seconds) deinit waits for the kernel to shut down before giving up on it
+SHUTDOWN_TIMEOUT = 5
+
+
+class KernelLoop:
+    """An asyncio event loop running on a daemon thread. All the async runtimes share one, so
+    having many kernels open doesn't mean having many reader threads"""
+
+    _instance: Optional["KernelLoop"] = None
+    _instance_lock = Lock()
+
+    loop: asyncio.AbstractEventLoop
+    thread: Thread
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls) -> "KernelLoop":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = KernelLoop()
+            return cls._instance
+
+    def submit(self, coro: Coroutine[Any, Any, Any]) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback: Callable[..., Any], *args: Any) -> None:
+        self.loop.call_soon_threadsafe(callback, *args)
+
+
+class AsyncJupyterRuntime(JupyterRuntime):
+    """JupyterRuntime on top of jupyter_client's asyncio API.
+
+    Starting, restarting and interrupting the kernel happen on the shared `KernelLoop`, so none of
+    them block nvim. The iopub and stdin channels are awaited concurrently on the loop and their
+    messages queued for `tick`, which processes them on nvim's thread exactly like the blocking
+    runtime does in push mode. Only local kernels and connection files are supported, kernels on a
+    jupyter server use the blocking runtime."""
+
+    kernel_manager: jupyter_client.AsyncKernelManager
+    kernel_client: Optional[jupyter_client.AsyncKernelClient]  # type: ignore
+
+    _loop: KernelLoop
+    _main_task: Optional[concurrent.futures.Future]
+    _accepting_requests: asyncio.Event
+    _stdin_queue: "Queue[Dict[str, Any]]"
+    _startup_error: Optional[Exception]
+    _restarting: Event
+    """set from `restart` until the kernel has restarted"""
+
+    def _start_kernel(self) -> None:
+        self.kernel_client = None
+        self._stdin_queue = Queue()
+        self._startup_error = None
+        self._restarting = Event()
+        # Set once the kernel is ready. Requests sent before that wait for it, otherwise their
+        # output would be thrown away with the kernel's startup messages
+        self._accepting_requests = asyncio.Event()
+
+        if ".json" not in self.kernel_name:
+            self.external_kernel = False
+            self.kernel_manager = jupyter_client.AsyncKernelManager(kernel_name=self.kernel_name)
+        else:
+            kernel_file = self.kernel_name
+            self.external_kernel = True
+            try:
+                kernel_json = json.load(open(kernel_file))
+            except FileNotFoundError:
+                raise ValueError(f"Could not find kernel file at path: {kernel_file}")
+
+            self.kernel_manager = jupyter_client.AsyncKernelManager(
+                kernel_name=kernel_json["kernel_name"]
+            )
+
+        self._loop = KernelLoop.get()
+        self._main_task = self._loop.submit(self._run())
+        self._main_task.add_done_callback(self._log_failure)
+
+    async def _run(self) -> None:
+        try:
+            if not self.external_kernel:
+                await self.kernel_manager.start_kernel()
+            # the client shares the manager's session, so `run_code` can build messages with it
+            # from nvim's thread
+            self.kernel_client = self.kernel_manager.client()
+            if self.external_kernel:
+                self.kernel_client.load_connection_file(connection_file=self.kernel_name)
+            self.kernel_client.start_channels()
+            if not self.external_kernel:
+                self.kernel_client.connection_file = (
+                    f"{self.kernel_client.data_dir}/runtime/kernel-{self.kernel_manager.kernel_id}.json"
+                )
+                self.kernel_client.write_connection_file()
+        except Exception as e:
+            self._startup_error = e
+            self._wake()
+            return
+
+        await asyncio.gather(self._read_iopub_async(), self._read_stdin_async())
+
+    async def _read_iopub_async(self) -> None:
+        assert self.kernel_client is not None
+        while not self._reader_stop.is_set():
+            try:
+                if not self._kernel_ready.is_set():
+                    await self.kernel_client.wait_for_ready(timeout=IOPUB_READER_TIMEOUT)
+                    if self._restarting.is_set():
+                        # answered by the kernel that's being restarted, wait for the new one
+                        await asyncio.sleep(IOPUB_READER_TIMEOUT / 10)
+                        continue
+                    self._kernel_ready.set()
+                    self._accepting_requests.set()
+                    self._wake()
+                    continue
+
+                message = await self.kernel_client.get_iopub_msg(timeout=IOPUB_READER_TIMEOUT)
+            except (EmptyQueueException, RuntimeError):
+                continue
+
+            # the kernel was restarted while we were waiting, its startup messages are discarded
+            if not self._kernel_ready.is_set():
+                continue
+
+            self._iopub_queue.put(message)
+            self._wake()
+
+    async def _read_stdin_async(self) -> None:
+        assert self.kernel_client is not None
+        while not self._reader_stop.is_set():
+            try:
+                message = await self.kernel_client.get_stdin_msg(timeout=IOPUB_READER_TIMEOUT)
+            except EmptyQueueException:
+                continue
+
+            self._stdin_queue.put(message)
+            self._wake()
+
+    async def _send_when_ready(self, message: Dict[str, Any]) -> None:
+        await self._accepting_requests.wait()
+        assert self.kernel_client is not None
+        self.kernel_client.shell_channel.send(message)
+
+    async def _shutdown(self) -> None:
+        if self._main_task is not None:
+            self._main_task.cancel()
+            # let the readers see the cancellation before their sockets are closed
+            await asyncio.sleep(0)
+        if self.kernel_client is not None:
+            self.kernel_client.stop_channels()
+            if self.external_kernel is False:
+                self.kernel_client.cleanup_connection_file()
+        if self.external_kernel is False and self.kernel_manager.has_kernel:
+            await self.kernel_manager.shutdown_kernel()
+
+    def _log_failure(self, future: concurrent.futures.Future) -> None:
+        if future.cancelled() or future.exception() is None:
+            return
+        e = future.exception()
+        self.nvim.async_call(
+            lambda: notify_error(self.nvim, f"Kernel '{self.kernel_name}': {e}")
+        )
+
+    def start_iopub_reader(self, on_message: Callable[[], None]) -> None:
+        # the event loop is already reading iopub, we only need to know who to wake up
+        self._on_iopub_message = on_message
+
+    def deinit(self) -> None:
+        self._reader_stop.set()
+
+        for path in self.allocated_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+        try:
+            self._loop.submit(self._shutdown()).result(timeout=SHUTDOWN_TIMEOUT)
+        except Exception:
+            # nvim is exiting or the kernel is already gone, there's nobody left to tell
+            pass
+
+    def interrupt(self) -> None:
+        self._loop.submit(self.kernel_manager.interrupt_kernel()).add_done_callback(
+            self._log_failure
+        )
+
+    def restart(self) -> None:
+        self.state = RuntimeState.STARTING
+        # the new kernel won't reply to anything we sent to the old one
+        self._outputs.clear()
+        self._restarting.set()
+        self._loop.submit(self._restart()).add_done_callback(self._log_failure)
+
+    async def _restart(self) -> None:
+        # requests sent from now on wait for the new kernel
+        self._accepting_requests.clear()
+        try:
+            await self.kernel_manager.restart_kernel()
+        finally:
+            # only once the old kernel is gone, or it could answer the reader's handshake
+            self._kernel_ready.clear()
+            self._restarting.clear()
+
+    def run_code(self, code: str, output: Output) -> str:
+        # Built here rather than through the client's `execute`, so the msg_id is known right away
+        # and the output can be registered before the kernel has even finished starting
+        message = self.kernel_manager.session.msg(
+            "execute_request",
+            {
+                "code": code,
+                "silent": False,
+                "store_history": True,
+                "user_expressions": {},
+                "allow_stdin": True,
+                "stop_on_error": True,
+            },
+        )
+        msg_id = message["header"]["msg_id"]
+        self._outputs[msg_id] = output
+        self._loop.submit(self._send_when_ready(message)).add_done_callback(
+            self._log_failure
+        )
+        return msg_id
+
+    def _poll_ready(self) -> bool:
+        # `_kernel_ready` is still the old kernel's until the restart is done
+        return self._kernel_ready.is_set() and not self._restarting.is_set()
+
+    def _get_iopub_msg(self) -> Dict[str, Any]:
+        return self._iopub_queue.get_nowait()
+
+    def tick(self) -> bool:
+        if self._startup_error is not None:
+            notify_error(
+                self.nvim,
+                f"Could not initialize kernel named '{self.kernel_name}'.\n"
+                f"Caused By: {self._startup_error}",
+            )
+            self._startup_error = None
+            return False
+
+        did_stuff = super().tick()
+        # input requests are pushed to us too, there's no need to wait for the input timer
+        self.tick_input()
+        return did_stuff
+
+    def tick_input(self) -> None:
+        try:
+            self.take_input(self._stdin_queue.get_nowait())
+        except EmptyQueueException:
+            pass
+
+    def send_stdin(self, text: str) -> None:
+        if self.kernel_client is not None:
+            self._loop.call_soon(self.kernel_client.input, text)
@@ -0,0 +1,61 @@
+from typing import Any, Callable, Dict, List, Optional
+
+from pynvim import Nvim
+from pynvim.api import NvimError
+
+
+class RpcBatch:
+    """Queues nvim API calls to send them in a single `nvim_call_atomic` round trip.
+
+    Calls run in the order they were added. Results are handed to the `on_result` callback of the
+    call that produced them when the batch is flushed. A failing call doesn't stop the rest of the
+    batch, the errors are raised together once everything else has been sent."""
+
+    nvim: Nvim
+    calls: List[List[Any]]
+    callbacks: Dict[int, Callable[[Any], None]]
+
+    def __init__(self, nvim: Nvim):
+        self.nvim = nvim
+        self.calls = []
+        self.callbacks = {}
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    def __enter__(self) -> "RpcBatch":
+        return self
+
+    def __exit__(self, exc_type, *_) -> None:
+        if exc_type is None:
+            self.flush()
+
+    def add(
+        self, method: str, *args: Any, on_result: Optional[Callable[[Any], None]] = None
+    ) -> None:
+        """Queue a call to the api function `method`, eg. "nvim_buf_set_lines" """
+        if on_result is not None:
+            self.callbacks[len(self.calls)] = on_result
+        self.calls.append([method, list(args)])
+
+    def flush(self) -> None:
+        calls, callbacks = self.calls, self.callbacks
+        self.calls, self.callbacks = [], {}
+
+        errors = []
+        start = 0
+        while start < len(calls):
+            results, error = self.nvim.api.call_atomic(calls[start:])
+            for i, result in enumerate(results):
+                callback = callbacks.get(start + i)
+                if callback is not None:
+                    callback(result)
+            if error is None:
+                break
+            # nvim_call_atomic stops at the first error: [index, type, message]
+            index, _, message = error
+            errors.append(f"{calls[start + index][0]}: {message}")
+            start += index + 1
+
+        if len(errors) > 0:
+            raise NvimError("\n".join(errors))
@@ -0,0 +1,223 @@
+from bisect import bisect_left, bisect_right
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+from pynvim import Nvim
+
+from molten.code_cell import CodeCell
+from molten.position import Position, current_snapshot, position_snapshot
+
+if TYPE_CHECKING:
+    from molten.moltenbuffer import MoltenKernel
+
+V = TypeVar("V")
+
+
+class CellMap(Dict[CodeCell, V]):
+    """A dict keyed by cells that reports cells being added and removed to `on_change` (with the
+    cell and whether it was added), so an index of them can be kept up to date"""
+
+    on_change: Optional[Callable[[CodeCell, bool], None]]
+
+    def __init__(self, on_change: Optional[Callable[[CodeCell, bool], None]] = None):
+        super().__init__()
+        self.on_change = on_change
+
+    def __setitem__(self, key: CodeCell, value: V) -> None:
+        added = key not in self
+        super().__setitem__(key, value)
+        if added and self.on_change is not None:
+            self.on_change(key, True)
+
+    def __delitem__(self, key: CodeCell) -> None:
+        super().__delitem__(key)
+        if self.on_change is not None:
+            self.on_change(key, False)
+
+    def pop(self, key: CodeCell, *default: Any) -> Any:
+        removed = key in self
+        value = super().pop(key, *default)
+        if removed and self.on_change is not None:
+            self.on_change(key, False)
+        return value
+
+    def clear(self) -> None:
+        cells = list(self.keys())
+        super().clear()
+        if self.on_change is not None:
+            for cell in cells:
+                self.on_change(cell, False)
+
+
+class CellIndex:
+    """The cells of one buffer sorted by where they begin, to find the cells at a position or in a
+    range with a binary search instead of asking nvim for the extmarks of every cell. Each cell is
+    stored with its owner, the kernel it belongs to.
+
+    Positions are read when the index is built and when a cell is inserted, so it has to be rebuilt
+    whenever the buffer changes. `key` identifies the state it was built from. Cells added and
+    removed in the meantime are kept in order by `insert` and `remove`."""
+
+    key: Hashable
+
+    cells: List[CodeCell]
+    owners: List[Any]
+    begins: List[Tuple[int, int]]
+    ends: List[Tuple[int, int]]
+    max_ends: List[Tuple[int, int]]
+    """furthest end of the cells up to and including each index, to know when to stop looking
+    back for cells that overlap the position"""
+
+    def __init__(self, cells: List[Tuple[CodeCell, Any]], key: Hashable):
+        self.key = key
+
+        with position_snapshot():
+            entries = [
+                (
+                    (cell.begin.lineno, cell.begin.colno),
+                    (cell.end.lineno, cell.end.colno),
+                    cell,
+                    owner,
+                )
+                for cell, owner in cells
+            ]
+        entries.sort(key=lambda entry: entry[0])
+
+        self.begins = [entry[0] for entry in entries]
+        self.ends = [entry[1] for entry in entries]
+        self.cells = [entry[2] for entry in entries]
+        self.owners = [entry[3] for entry in entries]
+        self.max_ends = []
+        for end in self.ends:
+            self.max_ends.append(max(end, self.max_ends[-1]) if self.max_ends else end)
+
+    def insert(self, cell: CodeCell, owner: Any) -> None:
+        with position_snapshot():
+            begin = (cell.begin.lineno, cell.begin.colno)
+            end = (cell.end.lineno, cell.end.colno)
+        i = bisect_right(self.begins, begin)
+        self.begins.insert(i, begin)
+        self.ends.insert(i, end)
+        self.cells.insert(i, cell)
+        self.owners.insert(i, owner)
+        self.max_ends.insert(i, max(end, self.max_ends[i - 1]) if i > 0 else end)
+        # the cells after it that it now reaches past
+        i += 1
+        while i < len(self.max_ends) and self.max_ends[i] < end:
+            self.max_ends[i] = end
+            i += 1
+
+    def remove(self, cell: CodeCell) -> bool:
+        """Returns False if the cell isn't in the index"""
+        with position_snapshot():
+            begin = (cell.begin.lineno, cell.begin.colno)
+        i = bisect_left(self.begins, begin)
+        while i < len(self.cells) and self.begins[i] == begin and self.cells[i] is not cell:
+            i += 1
+        if i == len(self.cells) or self.cells[i] is not cell:
+            return False
+
+        del self.begins[i]
+        del self.ends[i]
+        del self.cells[i]
+        del self.owners[i]
+        del self.max_ends[i]
+        # the cells after it that it reached past
+        while i < len(self.max_ends):
+            max_end = max(self.ends[i], self.max_ends[i - 1]) if i > 0 else self.ends[i]
+            if max_end == self.max_ends[i]:
+                break
+            self.max_ends[i] = max_end
+            i += 1
+        return True
+
+    def find(self, pos: Position, owner: Any = None) -> Optional[CodeCell]:
+        """The cell containing `pos`, the one that begins last if several do. Only cells of `owner`
+        are considered when it's given"""
+        target = (pos.lineno, pos.colno)
+        i = bisect_right(self.begins, target) - 1
+        while i >= 0 and self.max_ends[i] > target:
+            if target < self.ends[i] and (owner is None or self.owners[i] is owner):
+                return self.cells[i]
+            i -= 1
+        return None
+
+    def overlapping(self, span: CodeCell) -> List[Tuple[CodeCell, Any]]:
+        """The cells that overlap `span` (as in `CodeCell.overlaps`), with their owners"""
+        begin = (span.begin.lineno, span.begin.colno)
+        end = (span.end.lineno, span.end.colno)
+        found = []
+        i = bisect_left(self.begins, end) - 1
+        while i >= 0 and self.max_ends[i] > begin:
+            if self.ends[i] > begin:
+                found.append((self.cells[i], self.owners[i]))
+            i -= 1
+        found.reverse()
+        return found
+
+
+class SpanIndex:
+    """A CellIndex per buffer, over the cells of every kernel attached to it. Owned by Molten and
+    shared with the kernels, it's how the invariant that cells of different kernels never overlap
+    is checked without a linear scan of everyone's cells.
+
+    The kernels report the cells they add and remove (see `cell_changed`), which are inserted into
+    or removed from the index. It's only rebuilt when the buffer was edited, or when the kernels
+    attached to it change"""
+
+    nvim: Nvim
+    get_kernels: Callable[[int], List["MoltenKernel"]]
+    """the kernels attached to a buffer number"""
+    _indexes: Dict[int, CellIndex]
+    _checked: Dict[int, Optional[int]]
+    """the position_snapshot in which each index was last checked to be up to date"""
+
+    def __init__(self, nvim: Nvim, get_kernels: Callable[[int], List["MoltenKernel"]]):
+        self.nvim = nvim
+        self.get_kernels = get_kernels
+        self._indexes = {}
+        self._checked = {}
+
+    def get(self, bufno: int) -> CellIndex:
+        kernels = self.get_kernels(bufno)
+        index = self._indexes.get(bufno)
+        snapshot = current_snapshot()
+        if (
+            index is not None
+            and snapshot is not None
+            and self._checked.get(bufno) == snapshot
+            and index.key[1] == tuple(id(kernel) for kernel in kernels)
+        ):
+            # the buffer can't have changed within a snapshot
+            return index
+
+        key = (
+            self.nvim.api.buf_get_changedtick(bufno),
+            tuple(id(kernel) for kernel in kernels),
+        )
+        if index is None or index.key != key:
+            cells = [
+                (cell, kernel)
+                for kernel in kernels
+                for cell in kernel.outputs
+                if cell.bufno == bufno
+            ]
+            index = CellIndex(cells, key)
+            self._indexes[bufno] = index
+        self._checked[bufno] = snapshot
+        return index
+
+    def cell_changed(self, cell: CodeCell, owner: "MoltenKernel", added: bool) -> None:
+        """Keep the index of the cell's buffer up to date with a cell `owner` added or removed"""
+        index = self._indexes.get(cell.bufno)
+        if index is None:
+            # built with the cell (or without it) when it's needed
+            return
+        if added:
+            index.insert(cell, owner)
+        elif not index.remove(cell):
+            self.forget(cell.bufno)
+
+    def forget(self, bufno: int) -> None:
+        """Drop the index of a buffer that's going away, so it doesn't keep its cells alive"""
+        self._indexes.pop(bufno, None)
+        self._checked.pop(bufno, None)
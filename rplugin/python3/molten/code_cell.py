@@ -1,12 +1,14 @@
 from functools import total_ordering
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
 
 from pynvim import Nvim
-from molten.position import DynamicPosition, Position
+from molten.position import DynamicPosition, Position, position_snapshot
 
 
 @total_ordering
 class CodeCell:
+    __slots__ = ("nvim", "begin", "end", "bufno")
+
     nvim: Nvim
     begin: Union[Position, DynamicPosition]
     end: Union[Position, DynamicPosition]
@@ -60,12 +62,40 @@ class CodeCell:
         lines: List[str] = nvim.api.buf_get_lines(
             self.bufno, self.begin.lineno, self.end.lineno + 1, False
         )
+        return _slice_text(lines, self.begin.colno, self.end.colno)
+
+
+def get_cells_text(nvim: Nvim, cells: List[CodeCell]) -> List[str]:
+    """The text of each of the cells, like `CodeCell.get_text`, but with a single `buf_get_lines`
+    per buffer for the range of lines covering all of them"""
+    with position_snapshot():
+        bounds = [
+            (cell.begin.lineno, cell.begin.colno, cell.end.lineno, cell.end.colno) for cell in cells
+        ]
+
+    ranges: Dict[int, Tuple[int, int]] = {}
+    for cell, (begin_line, _, end_line, _) in zip(cells, bounds):
+        first, last = ranges.get(cell.bufno, (begin_line, end_line))
+        ranges[cell.bufno] = (min(first, begin_line), max(last, end_line))
+
+    buffer_lines = {
+        bufno: nvim.api.buf_get_lines(bufno, first, last + 1, False)
+        for bufno, (first, last) in ranges.items()
+    }
+
+    texts = []
+    for cell, (begin_line, begin_col, end_line, end_col) in zip(cells, bounds):
+        first = ranges[cell.bufno][0]
+        lines = buffer_lines[cell.bufno][begin_line - first : end_line - first + 1]
+        texts.append(_slice_text(lines, begin_col, end_col))
+    return texts
+
 
-        if len(lines) == 0:
-            return "" # apparently this can happen...
-        if len(lines) == 1:
-            return lines[0][self.begin.colno : self.end.colno]
-        else:
-            return "\n".join(
-                [lines[0][self.begin.colno :]] + lines[1:-1] + [lines[-1][: self.end.colno]]
-            )
+def _slice_text(lines: List[str], begin_col: int, end_col: int) -> str:
+    """The text from `begin_col` of the first line to `end_col` of the last one"""
+    if len(lines) == 0:
+        return "" # apparently this can happen...
+    if len(lines) == 1:
+        return lines[0][begin_col:end_col]
+    else:
+        return "\n".join([lines[0][begin_col:]] + lines[1:-1] + [lines[-1][:end_col]])
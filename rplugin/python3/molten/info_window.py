@@ -36,6 +36,7 @@ def create_info_window(nvim, molten_kernels, buffers, initialized):
             draw_kernel_info(
                 info_buf, running, m_kernel.kernel_id, spec.language, spec.argv, spec.resource_dir
             )
+            draw_kernel_stats(info_buf, m_kernel.runtime)
 
     if len(other_buf_kernels) > 0:
         info_buf.append(
@@ -49,6 +50,7 @@ def create_info_window(nvim, molten_kernels, buffers, initialized):
             draw_kernel_info(
                 info_buf, running, m_kernel.kernel_id, spec.language, spec.argv, spec.resource_dir
             )
+            draw_kernel_stats(info_buf, m_kernel.runtime)
 
     if len(other_kernels) > 0:
         info_buf.append([f" {len(other_kernels)} inactive kernel(s):", ""])
@@ -97,3 +99,13 @@ def draw_kernel_info(buf, running, kernel_name, language, argv, resource_dir):
     buf.append(f"   cmd:          {' '.join(argv)}")
     buf.api.add_highlight(-1, "String", len(buf) - 1, 16, -1)
     buf.append([f"   resource_dir: {resource_dir}", ""])
+
+
+def draw_kernel_stats(buf, runtime):
+    # replace the blank line that ends the kernel info
+    buf[-1] = (
+        f"   iopub:        {runtime.messages_processed} messages,"
+        f" {runtime.ticks_over_budget} ticks over budget"
+    )
+    buf.api.add_highlight(-1, "Number", len(buf) - 1, 16, -1)
+    buf.append("")
@@ -1,6 +1,6 @@
 from typing import Dict
 from pynvim.api import Buffer, Nvim
-from molten.code_cell import CodeCell
+from molten.code_cell import CodeCell, get_cells_text
 from molten.moltenbuffer import MoltenKernel
 import os
 from molten.outputbuffer import OutputBuffer
@@ -68,7 +68,7 @@ def import_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str):
 
                 for output_data in cell["outputs"]:
                     m_chunk, success = handle_output_types(nvim, output_data.get("output_type"), kernel, output_data)
-                    output.chunks.append(m_chunk)
+                    output.append_chunk(m_chunk)
                     output.success &= success
 
                 start = DynamicPosition(
@@ -155,6 +155,7 @@ def export_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str, overwrite: b
     nb = nbformat.read(filepath, as_version=NOTEBOOK_VERSION)
 
     molten_cells = sorted(kernel.outputs.items(), key=lambda x: x[0])
+    molten_texts = get_cells_text(nvim, [code_cell for code_cell, _ in molten_cells])
 
     if len(molten_cells) == 0:
         notify_warn(nvim, "No cell outputs to export")
@@ -163,14 +164,14 @@ def export_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str, overwrite: b
     nb_cells = list(filter(lambda x: x["cell_type"] == "code", nb["cells"]))
     nb_index = 0
     lang = kernel.runtime.kernel_manager.kernel_spec.language  # type: ignore
-    for mcell in molten_cells:
+    for mcell, molten_contents in zip(molten_cells, molten_texts):
         matched = False
         while nb_index < len(nb_cells):
             code_cell, output = mcell
             nb_cell = nb_cells[nb_index]
             nb_index += 1
 
-            if compare_contents(nvim, nb_cell, code_cell, lang):
+            if compare_contents(nvim, nb_cell, molten_contents, lang):
                 matched = True
                 outputs = [
                     nbformat.v4.new_output(
@@ -208,8 +209,7 @@ def export_outputs(nvim: Nvim, kernel: MoltenKernel, filepath: str, overwrite: b
     nbformat.write(nb, write_to)
 
 
-def compare_contents(nvim: Nvim, nb_cell, code_cell: CodeCell, lang: str) -> bool:
-    molten_contents = code_cell.get_text(nvim)
+def compare_contents(nvim: Nvim, nb_cell, molten_contents: str, lang: str) -> bool:
     nvim.exec_lua("_remove_comments = require('remove_comments').remove_comments")
     clean_nb = nvim.lua._remove_comments(nb_cell["source"] + "\n", lang)
     clean_molten = nvim.lua._remove_comments(molten_contents + "\n", lang)
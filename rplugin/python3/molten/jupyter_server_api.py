@@ -91,13 +91,11 @@ class JupyterAPIClient:
                 # 连接关闭或其他错误时退出线程
                 break
 
-    def get_iopub_msg(self, **kwargs):
-        if self._recv_queue.empty():
-            raise EmptyQueueException
+    def get_iopub_msg(self, timeout: float = 0, **kwargs):
+        if timeout:
+            return self._recv_queue.get(timeout=timeout)
 
-        response = self._recv_queue.get()
-
-        return response
+        return self._recv_queue.get_nowait()
 
     def execute(self, code: str):
         header = {
@@ -116,6 +114,7 @@ class JupyterAPIClient:
             }
         })
         self._socket.send(message)
+        return header['msg_id']
 
     def shutdown(self):
         self.requests.delete(self._kernel_api_base,
@@ -1,20 +1,25 @@
 from contextlib import AbstractContextManager
 from datetime import datetime
 from typing import IO, Callable, List, Optional, Dict, Tuple
-from queue import Queue
 import hashlib
+import time
 
 from pynvim import Nvim
 from pynvim.api import Buffer
-from molten.code_cell import CodeCell
+from molten.batch import RpcBatch
+from molten.cell_index import CellMap, SpanIndex
+from molten.code_cell import CodeCell, get_cells_text
 
 from molten.options import MoltenOptions
+from molten.render import RenderScheduler
 from molten.images import Canvas
 from molten.position import Position
 from molten.utils import notify_error, notify_info, notify_warn
-from molten.outputbuffer import OutputBuffer
-from molten.outputchunks import ImageOutputChunk, OutputChunk, OutputStatus
+from molten.outputbuffer import OutputBuffer, get_window_geometry
+from molten.outputchunks import ImageOutputChunk, OutputChunk, OutputStatus, StreamOutputChunk
+from molten.async_runtime import AsyncJupyterRuntime
 from molten.runtime import JupyterRuntime
+from molten.runtime_state import RuntimeState
 
 
 class MoltenKernel:
@@ -23,6 +28,7 @@ class MoltenKernel:
 
     nvim: Nvim
     canvas: Canvas
+    render_scheduler: RenderScheduler
     highlight_namespace: int
     extmark_namespace: int
     buffers: List[Buffer]
@@ -32,9 +38,9 @@ class MoltenKernel:
     kernel_id: str
     """name unique to this specific jupyter runtime. Only used within Molten. Human Readable"""
 
-    outputs: Dict[CodeCell, OutputBuffer]
-    current_output: Optional[CodeCell]
-    queued_outputs: "Queue[CodeCell]"
+    outputs: CellMap[OutputBuffer]
+    running_cells: List[CodeCell]
+    """cells that were sent to the kernel and haven't finished yet, in the order they were sent"""
 
     selected_cell: Optional[CodeCell]
     should_show_floating_win: bool
@@ -43,10 +49,20 @@ class MoltenKernel:
     options: MoltenOptions
     output_statuses: Dict[Optional[CodeCell], OutputStatus]
 
+    tick_delay: int
+    """ms to wait before ticking this kernel again, only used with `adaptive_tick`"""
+    next_tick: float
+    """`time.monotonic()` at which this kernel is next due for a tick"""
+
+    span_index: SpanIndex
+    """shared with the other kernels, finds cells by position"""
+
     def __init__(
         self,
         nvim: Nvim,
         canvas: Canvas,
+        render_scheduler: RenderScheduler,
+        span_index: SpanIndex,
         highlight_namespace: int,
         extmark_namespace: int,
         main_buffer: Buffer,
@@ -56,18 +72,22 @@ class MoltenKernel:
     ):
         self.nvim = nvim
         self.canvas = canvas
+        self.render_scheduler = render_scheduler
+        self.span_index = span_index
         self.highlight_namespace = highlight_namespace
         self.extmark_namespace = extmark_namespace
         self.buffers = [main_buffer]
 
         self._doautocmd("MoltenInitPre")
 
-        self.runtime = JupyterRuntime(nvim, kernel_name, kernel_id, options)
+        if options.async_runtime and not kernel_name.startswith(("http://", "https://")):
+            self.runtime = AsyncJupyterRuntime(nvim, kernel_name, kernel_id, options)
+        else:
+            self.runtime = JupyterRuntime(nvim, kernel_name, kernel_id, options)
         self.kernel_id = kernel_id
 
-        self.outputs = {}
-        self.current_output = None
-        self.queued_outputs = Queue()
+        self.outputs = CellMap(lambda cell, added: span_index.cell_changed(cell, self, added))
+        self.running_cells = []
 
         self.selected_cell = None
         self.output_statuses = {}
@@ -76,6 +96,21 @@ class MoltenKernel:
 
         self.options = options
 
+        self.tick_delay = self.options.tick_rate_min
+        self.next_tick = time.monotonic()
+
+        # the async runtime always pushes, kernels on a jupyter server fall back to the blocking
+        # runtime and need the reader thread to do the same
+        if self.options.iopub_delivery == "push" or self.options.async_runtime:
+            self.runtime.start_iopub_reader(self._request_tick)
+
+    def _request_tick(self) -> None:
+        """Ask nvim to tick this kernel as soon as it's done with what it's doing. Safe to call
+        from the runtime's iopub reader thread"""
+        self.nvim.async_call(
+            lambda: self.nvim.funcs.MoltenTickKernel(self.kernel_id, async_=True)
+        )
+
     def _doautocmd(self, autocmd: str, opts: Dict = {}) -> None:
         assert " " not in autocmd
         opts["pattern"] = autocmd
@@ -87,49 +122,52 @@ class MoltenKernel:
 
     def deinit(self) -> None:
         self._doautocmd("MoltenDeinitPre")
+        self.render_scheduler.discard(self)
         self.runtime.deinit()
         self._doautocmd("MoltenDeinitPost")
 
     def interrupt(self) -> None:
         self.runtime.interrupt()
+        self.wake_tick()
 
     def restart(self, delete_outputs: bool = False) -> None:
         if delete_outputs:
             self.clear_virt_outputs()
             self.clear_interface()
             self.clear_open_output_windows()
-            self.outputs = {}
+            self.outputs.clear()
         else:
-            for output in self.outputs.values():
-                if output.output.status == OutputStatus.RUNNING:
-                    output.output.status = OutputStatus.DONE
-                    output.output.success = False
+            for span in self.running_cells:
+                if span in self.outputs:
+                    self.outputs[span].output.status = OutputStatus.DONE
+                    self.outputs[span].output.success = False
+        self.running_cells = []
 
         self.runtime.restart()
+        self.wake_tick()
 
     def run_code(self, code: str, span: CodeCell) -> None:
         if not self.try_delete_overlapping_cells(span):
             return
         self.output_statuses[span] = OutputStatus.RUNNING
-        self.runtime.run_code(code)
 
         self.outputs[span] = OutputBuffer(
             self.nvim, self.canvas, self.extmark_namespace, self.options
         )
-        self.queued_outputs.put(span)
+        self.runtime.run_code(code, self.outputs[span].output)
+        self.running_cells.append(span)
+        self.wake_tick()
 
         self.selected_cell = span
 
         if not self.options.virt_text_output:
             self.should_show_floating_win = True
 
-        self.update_interface()
-
-        self._check_if_done_running()
+        self.request_update()
 
     def reevaluate_all(self) -> None:
-        for span in sorted(self.outputs.keys(), key=lambda s: s.begin):
-            code = span.get_text(self.nvim)
+        spans = sorted(self.outputs.keys(), key=lambda s: s.begin)
+        for span, code in zip(spans, get_cells_text(self.nvim, spans)):
             self.run_code(code, span)
 
     def reevaluate_cell(self) -> bool:
@@ -208,44 +246,34 @@ class MoltenKernel:
 
         return True
 
-    def _check_if_done_running(self) -> None:
-        # TODO: refactor
-        is_idle = (self.current_output is None or not self.current_output in self.outputs) or (
-            self.current_output is not None
-            and self.outputs[self.current_output].output.status == OutputStatus.DONE
-        )
-        if is_idle and not self.queued_outputs.empty():
-            key = self.queued_outputs.get_nowait()
-            self.current_output = key
-
     def tick(self) -> None:
-        self._check_if_done_running()
-
         was_ready = self.runtime.is_ready()
-        if self.current_output is None or not self.current_output in self.outputs:
-            did_stuff = self.runtime.tick(None)
-        else:
-            output = self.outputs[self.current_output].output
-            starting_status = output.status
-            did_stuff = self.runtime.tick(output)
-
-            if starting_status != OutputStatus.DONE and output.status == OutputStatus.DONE:
-                if self.options.auto_open_html_in_browser:
-                    self.open_in_browser(silent=True)
-                if self.options.auto_image_popup:
-                    self.open_image_popup(silent=True)
-
-                output.end_time = datetime.now()
-
-                # HACK: Update the interface here to avoid the incomplete
-                # update such as the status in output is still `Running`
-                # when it's already done.
-                self.update_interface()
-                # Update the output status
-                self.output_statuses[self.current_output] = output.status
-
-        if self.options.output_show_exec_time or did_stuff:
-            self.update_interface()
+        did_stuff = self.runtime.tick()
+
+        finished = False
+        still_running = []
+        for span in self.running_cells:
+            if span not in self.outputs:  # deleted before it ran
+                continue
+            output = self.outputs[span].output
+            if output.status != OutputStatus.DONE:
+                still_running.append(span)
+                continue
+
+            finished = True
+            output.end_time = datetime.now()
+            self.output_statuses[span] = output.status
+        self.running_cells = still_running
+
+        if finished:
+            if self.options.auto_open_html_in_browser:
+                self.open_in_browser(silent=True)
+            if self.options.auto_image_popup:
+                self.open_image_popup(silent=True)
+
+        # the execution time in the header only changes while a cell is running
+        if finished or did_stuff or (self.options.output_show_exec_time and self._is_running()):
+            self.request_update()
 
         if not was_ready and self.runtime.is_ready():
             self._doautocmd(
@@ -261,11 +289,41 @@ class MoltenKernel:
                 f"Kernel '{self.runtime.kernel_name}' (id: {self.kernel_id}) is ready.",
             )
 
+        if self.runtime.backlogged:
+            # don't wait for the timer, but let nvim handle input before we continue draining
+            self._request_tick()
+
+        self._schedule_next_tick(did_stuff)
+
+    def _is_running(self) -> bool:
+        return any(
+            span in self.outputs and self.outputs[span].output.status == OutputStatus.RUNNING
+            for span in self.running_cells
+        )
+
+    def _is_busy(self) -> bool:
+        """True while there is (or is about to be) something to read from the kernel"""
+        return self.runtime.state != RuntimeState.IDLE or len(self.running_cells) > 0
+
+    def _schedule_next_tick(self, did_stuff: bool) -> None:
+        """Poll quickly while the kernel is busy, and back off exponentially (up to
+        `tick_rate_max`) while it's idle"""
+        if did_stuff or self._is_busy():
+            self.tick_delay = self.options.tick_rate_min
+        else:
+            self.tick_delay = min(self.tick_delay * 2, self.options.tick_rate_max)
+        self.next_tick = time.monotonic() + self.tick_delay / 1000
+
+    def wake_tick(self) -> None:
+        """Make this kernel due for a tick right away, eg. after sending it code"""
+        self.tick_delay = self.options.tick_rate_min
+        self.next_tick = time.monotonic()
+
     def tick_input(self) -> None:
         self.runtime.tick_input()
 
     def send_stdin(self, input: str) -> None:
-        self.runtime.kernel_client.input(input)
+        self.runtime.send_stdin(input)
 
     def enter_output(self) -> None:
         if self.selected_cell is not None:
@@ -301,13 +359,7 @@ class MoltenKernel:
 
     def _get_selected_span(self) -> Optional[CodeCell]:
         current_position = self._get_cursor_position()
-        selected = None
-        for span in reversed(self.outputs.keys()):
-            if current_position in span:
-                selected = span
-                break
-
-        return selected
+        return self.span_index.get(current_position.bufno).find(current_position, owner=self)
 
     def try_delete_overlapping_cells(self, span: CodeCell) -> bool:
         """Delete the code cells in this kernel that overlap with the given span, if overlapping
@@ -315,10 +367,9 @@ class MoltenKernel:
         Returns:
             False if the span overlaps with a currently running cell, True otherwise
         """
-        for output_span in list(self.outputs.keys()):
-            if output_span.overlaps(span):
-                if not self._delete_cell(output_span):
-                    return False
+        for output_span, owner in self.span_index.get(span.bufno).overlapping(span):
+            if owner is self and not self._delete_cell(output_span):
+                return False
         return True
 
     def _delete_cell(self, cell: CodeCell, quiet=False) -> bool:
@@ -335,8 +386,6 @@ class MoltenKernel:
         self.outputs[cell].clear_virt_output(cell.bufno)
         cell.clear_interface(self.highlight_namespace)
         del self.outputs[cell]
-        if self.current_output == cell:
-            self.current_output = None
         if self.selected_cell == cell:
             self.selected_cell = None
         return True
@@ -359,7 +408,15 @@ class MoltenKernel:
             if cell.bufno == buffer_number:
                 self._delete_cell(cell, quiet=True)
 
+    def request_update(self) -> None:
+        """Redraw with the next frame of the render scheduler, use this instead of
+        `update_interface` for updates that can come in bursts (output, cursor movement)"""
+        self.render_scheduler.mark_dirty(self)
+
     def update_interface(self) -> None:
+        # drawing now, a pending frame would draw the same thing again
+        self.render_scheduler.discard(self)
+
         buffer_numbers = [buf.number for buf in self.buffers]
         if self.nvim.current.buffer.number not in buffer_numbers:
             return
@@ -382,14 +439,19 @@ class MoltenKernel:
 
         self.selected_cell = new_selected_cell
 
+        # everything is drawn in one round trip, before the canvas places images on top of it
+        batch = RpcBatch(self.nvim)
+
         if self.selected_cell is not None:
             # Always show selected cell, regardless of status
-            self._show_selected(self.selected_cell)
+            self._show_selected(self.selected_cell, batch)
 
-        if self.options.virt_text_output:
+        if self.options.virt_text_output and len(self.outputs) > 0:
+            geometry = get_window_geometry(self.nvim)
             for span, output in self.outputs.items():
-                output.show_virtual_output(span.end)
+                output.show_virtual_output(span.end, geometry, batch)
 
+        batch.flush()
         self.canvas.present()
 
         self.updating_interface = False
@@ -410,55 +472,42 @@ class MoltenKernel:
                 and new_selected_cell.end.lineno < self.nvim.funcs.line("w$")
                 and self.should_show_floating_win
             ):
-                self.update_interface()
+                self.request_update()
             return
 
-        self.update_interface()
+        self.request_update()
 
-    def _show_selected(self, span: CodeCell) -> None:
+    def _show_selected(self, span: CodeCell, batch: RpcBatch) -> None:
         """Show the selected cell. Can only have a selected cell in the current buffer"""
         buf = self.nvim.current.buffer
         if buf.number not in [b.number for b in self.buffers]:
             return
 
-        if span.begin.lineno == span.end.lineno:
-            self.nvim.funcs.nvim_buf_add_highlight(
+        begin, end = span.begin, span.end
+        begin_lineno, begin_colno = begin.lineno, begin.colno
+        end_lineno, end_colno = end.lineno, end.colno
+
+        def add_highlight(lineno: int, col_start: int, col_end: int) -> None:
+            batch.add(
+                "nvim_buf_add_highlight",
                 buf.number,
                 self.highlight_namespace,
                 self.options.hl.cell,
-                span.begin.lineno,
-                span.begin.colno,
-                span.end.colno,
+                lineno,
+                col_start,
+                col_end,
             )
+
+        if begin_lineno == end_lineno:
+            add_highlight(begin_lineno, begin_colno, end_colno)
         else:
-            self.nvim.funcs.nvim_buf_add_highlight(
-                buf.number,
-                self.highlight_namespace,
-                self.options.hl.cell,
-                span.begin.lineno,
-                span.begin.colno,
-                -1,
-            )
-            for lineno in range(span.begin.lineno + 1, span.end.lineno):
-                self.nvim.funcs.nvim_buf_add_highlight(
-                    buf.number,
-                    self.highlight_namespace,
-                    self.options.hl.cell,
-                    lineno,
-                    0,
-                    -1,
-                )
-            self.nvim.funcs.nvim_buf_add_highlight(
-                buf.number,
-                self.highlight_namespace,
-                self.options.hl.cell,
-                span.end.lineno,
-                0,
-                span.end.colno,
-            )
+            add_highlight(begin_lineno, begin_colno, -1)
+            for lineno in range(begin_lineno + 1, end_lineno):
+                add_highlight(lineno, 0, -1)
+            add_highlight(end_lineno, 0, end_colno)
 
         if self.should_show_floating_win:
-            self.outputs[span].show_floating_win(span.end)
+            self.outputs[span].show_floating_win(end, batch)
         else:
             self.outputs[span].clear_float_win()
 
@@ -481,6 +530,9 @@ def write_html_from_chunks(
     text_html = ""
     plotly_data = []
     for chunk in chunks:
+        if isinstance(chunk, StreamOutputChunk):
+            # printed text, never html, and building its data would read back what's spilled
+            continue
         if chunk.output_type == "display_data" and chunk.jupyter_data:
             if "application/vnd.plotly.v1+json" in chunk.jupyter_data:
                 plotly_data.append(chunk.jupyter_data["application/vnd.plotly.v1+json"])
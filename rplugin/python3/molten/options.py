@@ -31,6 +31,8 @@ class HL:
 
 
 class MoltenOptions:
+    adaptive_tick: bool
+    async_runtime: bool
     auto_image_popup: bool
     auto_init_behavior: str
     auto_open_html_in_browser: bool
@@ -41,9 +43,12 @@ class MoltenOptions:
     enter_output_behavior: str
     image_location: str
     image_provider: str
+    iopub_delivery: str
     limit_output_chars: int
     open_cmd: Optional[str]
     output_crop_border: bool
+    output_memory_per_cell: int
+    output_memory_per_kernel: int
     output_show_exec_time: bool
     output_show_more: bool
     output_virt_lines: bool
@@ -54,11 +59,16 @@ class MoltenOptions:
     output_win_max_width: int
     output_win_style: Optional[str]
     output_win_zindex: Optional[str]
+    render_fps: int
     save_path: str
     split_direction: str | None
     split_size: int | None
     show_mimetype_debug: bool
+    tick_max_messages: int
+    tick_max_time: int
     tick_rate: int
+    tick_rate_max: int
+    tick_rate_min: int
     use_border_highlights: bool
     verify_ssl: bool
     virt_lines_off_by_1: bool
@@ -73,6 +83,8 @@ class MoltenOptions:
         self.hl = HL()
         # fmt: off
         CONFIG_VARS = [
+            ("molten_adaptive_tick", False),
+            ("molten_async_runtime", False),
             ("molten_auto_image_popup", False),
             ("molten_auto_init_behavior", "init"), # "raise" or "init"
             ("molten_auto_open_html_in_browser", False),
@@ -83,8 +95,11 @@ class MoltenOptions:
             ("molten_enter_output_behavior", "open_then_enter"),
             ("molten_image_location", "both"), # "both", "float", "virt"
             ("molten_image_provider", "none"),
+            ("molten_iopub_delivery", "poll"), # "poll" or "push"
             ("molten_open_cmd", None),
             ("molten_output_crop_border", True),
+            ("molten_output_memory_per_cell", 2000000),
+            ("molten_output_memory_per_kernel", 50000000),
             ("molten_output_show_exec_time", True),
             ("molten_output_show_more", False),
             ("molten_output_virt_lines", False),
@@ -95,11 +110,16 @@ class MoltenOptions:
             ("molten_output_win_max_height", 999999),
             ("molten_output_win_max_width", 999999),
             ("molten_output_win_style", False),
+            ("molten_render_fps", 30),
             ("molten_save_path", os.path.join(nvim.funcs.stdpath("data"), "molten")),
             ("molten_split_direction", "right"),
             ("molten_split_size", 40),
             ("molten_show_mimetype_debug", False),
+            ("molten_tick_max_messages", 500),
+            ("molten_tick_max_time", 50),
             ("molten_tick_rate", 500),
+            ("molten_tick_rate_max", 2000),
+            ("molten_tick_rate_min", 20),
             ("molten_use_border_highlights", False),
             ("molten_verify_ssl", False),
             ("molten_virt_lines_off_by_1", False),
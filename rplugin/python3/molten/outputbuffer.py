@@ -1,16 +1,42 @@
 from datetime import datetime
-from typing import Any, List, Optional, Tuple, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
 from pynvim import Nvim
 from pynvim.api import Buffer, Window
 
+from molten.batch import RpcBatch
 from molten.images import Canvas
-from molten.outputchunks import ImageOutputChunk, Output, OutputStatus
+from molten.ansi import ansi_group
+from molten.outputchunks import Highlight, ImageOutputChunk, Output, OutputStatus, OutputText
 from molten.options import MoltenOptions
 from molten.position import DynamicPosition, Position
 from molten.utils import notify_error
 
 
+# Lines above a cell fetched at once when looking for the lines the output covers, doubled every
+# time they're all covered
+COVER_LINES_FETCH = 16
+
+
+class WindowGeometry(NamedTuple):
+    """The parts of the current window that virtual output is laid out against"""
+
+    col: int
+    width: int
+    height: int
+    last_line: int
+
+
+def get_window_geometry(nvim: Nvim) -> WindowGeometry:
+    win_info = nvim.funcs.getwininfo(nvim.current.window.handle)[0]
+    return WindowGeometry(
+        win_info["wincol"],
+        win_info["width"] - win_info["textoff"],
+        win_info["height"],
+        nvim.funcs.line("$"),
+    )
+
+
 class OutputBuffer:
     nvim: Nvim
     canvas: Canvas
@@ -23,6 +49,15 @@ class OutputBuffer:
     extmark_namespace: int
     virt_text_id: Optional[int]
     displayed_status: OutputStatus
+    _virt_render_key: Optional[Tuple[Any, ...]]
+    """what the virtual output was last drawn from, it's only redrawn when this changes"""
+    _virt_text: OutputText
+    _float_text: OutputText
+    _display_header: Optional[str]
+    _display_lines: int
+    """lines in `display_buf` after the header"""
+    _display_text_lines: int
+    """how many of those are the output's text"""
 
     options: MoltenOptions
     lua: Any
@@ -52,6 +87,12 @@ class OutputBuffer:
         self.extmark_namespace = extmark_namespace
         self.virt_text_id = None
         self.displayed_status = OutputStatus.HOLD
+        self._virt_render_key = None
+        self._virt_text = OutputText()
+        self._float_text = OutputText()
+        self._display_header = None
+        self._display_lines = 0
+        self._display_text_lines = 0
 
         self.options = options
         self.nvim.exec_lua("_ow = require('output_window')")
@@ -148,6 +189,8 @@ class OutputBuffer:
                     redraw = True
             if redraw:
                 self.canvas.present()
+            # no need to hold on to the text while nothing shows it
+            self._float_text = OutputText()
         if self.display_virt_lines is not None:
             del self.display_virt_lines
             self.display_virt_lines = None
@@ -181,85 +224,64 @@ class OutputBuffer:
             self.clear_virt_output(anchor.bufno)
             # clear_virtual_output already set virt_hidden=True
 
-    def set_win_option(self, option: str, value) -> None:
+    def set_win_option(self, option: str, value, batch: Optional[RpcBatch] = None) -> None:
         if self.display_win:
-            self.nvim.api.set_option_value(
-                option,
-                value,
-                {"scope": "local", "win": self.display_win.handle},
-            )
-
-    def build_output_text(self, shape, buf: int, virtual: bool) -> Tuple[List[str], int]:
-        lineno = 1  # we add a status line at the top in the end
-        lines_str = ""
-        # images are rendered with virtual lines by image.nvim
-        virtual_lines = 0
-        if len(self.output.chunks) > 0:
-            x = 0
-            for chunk in self.output.chunks:
-                y = lineno
-                if virtual:
-                    y = shape[1]
-                chunktext, virt_lines = chunk.place(
-                    buf,
-                    self.options,
-                    x,
-                    y,
-                    shape,
-                    self.canvas,
-                    virtual,
-                    winnr=self.nvim.current.window.handle if virtual else None,
-                )
-                lines_str += chunktext
-                lineno += chunktext.count("\n")
-                virtual_lines += virt_lines
-                x = len(lines_str) - lines_str.rfind("\n")
-
-            limit = self.options.limit_output_chars
-            if limit and len(lines_str) > limit:
-                lines_str = lines_str[:limit]
-                lines_str += f"\n...truncated to {limit} chars\n"
-
-            lines = lines_str.split("\n")
-            lineno = len(lines) + virtual_lines
-        else:
-            lines = []
+            args = (option, value, {"scope": "local", "win": self.display_win.handle})
+            if batch is not None:
+                batch.add("nvim_set_option_value", *args)
+            else:
+                self.nvim.api.set_option_value(*args)
+
+    def build_output_text(
+        self, shape, buf: int, virtual: bool, max_lines: int = 0
+    ) -> Tuple[List[str], int, int]:
+        """The lines to display, the number of lines there are in all and the height they take
+        up. With `max_lines`, only the header and the first `max_lines` lines of text are
+        returned"""
+        text = self._virt_text if virtual else self._float_text
+        lines, virtual_lines = text.build(
+            self.output,
+            buf,
+            self.options,
+            shape,
+            self.canvas,
+            virtual,
+            winnr=self.nvim.current.window.handle if virtual else None,
+            max_lines=max_lines,
+        )
 
         # Remove trailing empty lines
-        while len(lines) > 0 and lines[-1] == "":
-            lines.pop()
+        total = text.lines_total
+        del lines[total:]
 
         # HACK: add an extra line for snacks image in windows
         if self.options.image_provider == "snacks.nvim":
-            lines.append("")
+            if len(lines) == total:
+                lines.append("")
+            total += 1
 
         lines.insert(0, self._get_header_text(self.output))
-        return lines, len(lines) - 1 + virtual_lines
-
-    def show_virtual_output(self, anchor: Position) -> None:
+        return lines, total + 1, total + virtual_lines
+
+    def show_virtual_output(
+        self,
+        anchor: Position,
+        geometry: Optional[WindowGeometry] = None,
+        batch: Optional[RpcBatch] = None,
+    ) -> None:
+        """Draw the output as virtual lines below `anchor`. `geometry` is the current window's,
+        pass it in when drawing many outputs at once to only fetch it once. When `batch` is given
+        the extmark is only updated (and the canvas should only be presented) once it's flushed"""
         if self.virt_hidden:
             return
         if self.displayed_status == OutputStatus.DONE and self.virt_text_id is not None:
             return
         offset = self.calculate_offset(anchor) if self.options.cover_empty_lines else 0
-        self.displayed_status = self.output.status
-
-        buf = self.nvim.buffers[anchor.bufno]
-
-        # clear the existing virtual text
-        if self.virt_text_id is not None:
-            self.nvim.funcs.nvim_buf_del_extmark(
-                anchor.bufno, self.extmark_namespace, self.virt_text_id
-            )
-            self.virt_text_id = None
 
-        win = self.nvim.current.window
-        win_info = self.nvim.funcs.getwininfo(win.handle)[0]
-        win_col = win_info["wincol"]
+        if geometry is None:
+            geometry = get_window_geometry(self.nvim)
         win_row = anchor.lineno + offset
-        win_width = win_info["width"] - win_info["textoff"]
-        win_height = win_info["height"]
-        last = self.nvim.funcs.line("$")
+        last = geometry.last_line
 
         if self.options.virt_lines_off_by_1 and win_row < last - 1:
             win_row += 1
@@ -267,52 +289,94 @@ class OutputBuffer:
         if win_row > last:
             win_row = last
 
+        # the header covers the status and running time, everything else comes from the chunks
+        render_key = (self.output.version, self._get_header_text(self.output), win_row, geometry)
+        if self.virt_text_id is not None and render_key == self._virt_render_key:
+            return
+        self._virt_render_key = render_key
+        self.displayed_status = self.output.status
+
+        own_batch = batch is None
+        if batch is None:
+            batch = RpcBatch(self.nvim)
+
         shape = (
-            win_col,
+            geometry.col,
             win_row,
-            win_width,
-            win_height,
+            geometry.width,
+            geometry.height,
+        )
+        # the lines past the ones that fit are only counted
+        lines, l, _ = self.build_output_text(
+            shape, anchor.bufno, True, max(self.options.virt_text_max_lines - 1, 1)
         )
-        lines, _ = self.build_output_text(shape, anchor.bufno, True)
-        l = len(lines)
         if l > self.options.virt_text_max_lines:
             lines = lines[: self.options.virt_text_max_lines - 1]
+            text_lines = len(lines) - 1
             lines.append(f"󰁅 {l - self.options.virt_text_max_lines + 1} More Lines ")
+        else:
+            text_lines = len(lines) - 1
+
+        hl = self.options.hl.virtual_text
+        virt_lines: List[List[Tuple[str, Any]]] = [[(line, hl)] for line in lines]
+        highlights = self._virt_text.highlights_between(0, text_lines)
+        start = 0
+        while start < len(highlights):
+            # the highlights of one line, the first line is the header
+            lineno = highlights[start][0]
+            end = start
+            while end < len(highlights) and highlights[end][0] == lineno:
+                end += 1
+            virt_lines[lineno + 1] = _styled_chunks(
+                lines[lineno + 1], highlights[start:end], hl, batch
+            )
+            start = end
 
-        self.virt_text_id = buf.api.set_extmark(
+        opts: Dict[str, Any] = {"virt_lines": virt_lines}
+        if self.virt_text_id is not None:
+            # moving the existing extmark replaces its virtual lines
+            opts["id"] = self.virt_text_id
+        batch.add(
+            "nvim_buf_set_extmark",
+            anchor.bufno,
             self.extmark_namespace,
             win_row,
             0,
-            {
-                "virt_lines": [[(line, self.options.hl.virtual_text)] for line in lines],
-            },
+            opts,
+            on_result=self._set_virt_text_id,
         )
-        self.canvas.present()
+
+        if own_batch:
+            batch.flush()
+            self.canvas.present()
+
+    def _set_virt_text_id(self, extmark_id: int) -> None:
+        self.virt_text_id = extmark_id
 
     def calculate_offset(self, anchor: Position) -> int:
+        """How many lines above `anchor` the output starts, to cover the empty lines (and the ones
+        starting with `cover_lines_starting_with`) at the end of the cell"""
+        prefixes = tuple(self.options.cover_lines_starting_with)
         offset = 0
         lineno = anchor.lineno
+        count = COVER_LINES_FETCH
         while lineno > 0:
-            current_line = self.nvim.api.buf_get_lines(
-                anchor.bufno,
-                lineno,
-                lineno + 1,
-                False,
-            )[0]
-            is_comment = False
-            for x in self.options.cover_lines_starting_with:
-                if current_line.startswith(x):
-                    is_comment = True
-                    break
-            if current_line != "" and not is_comment:
-                return offset
-            else:
-                lineno -= 1
+            # the lines up to `lineno` in one request, walking back from its end
+            start = max(lineno - count + 1, 1)
+            lines = self.nvim.api.buf_get_lines(anchor.bufno, start, lineno + 1, False)
+            for line in reversed(lines):
+                if line != "" and not line.startswith(prefixes):
+                    return offset
                 offset -= 1
+            lineno = start - 1
+            count *= 2
         # Only get here if current_pos.lineno == 0
         return 0
 
-    def show_floating_win(self, anchor: Position) -> None:
+    def show_floating_win(self, anchor: Position, batch: Optional[RpcBatch] = None) -> None:
+        """Open (or move) the output window below `anchor`. When `batch` is given the window's
+        contents and options are only set (and the canvas should only be presented) once it's
+        flushed"""
         win = self.nvim.current.window
         win_col = 0
         offset = 0
@@ -324,19 +388,21 @@ class OutputBuffer:
 
         if win_row <= 0:  # anchor position is off screen
             return
-        win_width = win.width
-        win_height = win.height
+        win_info = self.nvim.funcs.getwininfo(win.handle)[0]
+        win_width = win_info["width"]
+        win_height = win_info["height"]
 
         border_w, border_h = border_size(self.options.output_win_border)
 
         win_height -= border_h
         win_width -= border_w
 
-        # Clear buffer:
-        self.display_buf.api.set_lines(0, -1, False, [])
+        own_batch = batch is None
+        if batch is None:
+            batch = RpcBatch(self.nvim)
 
         sign_col_width = 0
-        text_off = self.nvim.funcs.getwininfo(win.handle)[0]["textoff"]
+        text_off = win_info["textoff"]
         if not self.options.output_win_cover_gutter:
             sign_col_width = text_off
 
@@ -346,13 +412,11 @@ class OutputBuffer:
             win_width - sign_col_width,
             win_height,
         )
-        lines, real_height = self.build_output_text(shape, self.display_buf.number, False)
+        lines, _, real_height = self.build_output_text(shape, self.display_buf.number, False)
 
-        # You can't append lines normally, there will be a blank line at the top
-        self.display_buf[0] = lines[0]
-        self.display_buf.append(lines[1:])
-        self.nvim.api.set_option_value(
-            "filetype", "molten_output", {"buf": self.display_buf.handle}
+        self._write_display_buf(lines, batch)
+        batch.add(
+            "nvim_set_option_value", "filetype", "molten_output", {"buf": self.display_buf.handle}
         )
 
         # Open output window
@@ -395,7 +459,7 @@ class OutputBuffer:
                 and height == self.options.output_win_max_height
             ):
                 # the entire window size is shown, but the buffer still has more lines to render
-                hidden_lines = len(self.display_buf) - height
+                hidden_lines = len(lines) - height
                 if self.options.output_win_cover_gutter and type(border) == list:
                     border_pad = border[5 % len(border)][0] * text_off
                     win_opts["footer"] = [
@@ -407,21 +471,23 @@ class OutputBuffer:
                 win_opts["footer_pos"] = "left"
 
             if self.display_win is None or not self.display_win.valid:  # open a new window
+                # opened right away, the options below need its handle
                 self.display_win = self.nvim.api.open_win(
                     self.display_buf.number,
                     False,
                     win_opts,
                 )
                 hl = self.options.hl
-                self.set_win_option("winhighlight", f"Normal:{hl.win},NormalNC:{hl.win_nc}")
+                self.set_win_option(
+                    "winhighlight", f"Normal:{hl.win},NormalNC:{hl.win_nc}", batch
+                )
                 # TODO: Refactor once MoltenOutputWindowOpen autocommand is a thing.
                 # note, the above setting will probably stay there, just so users can set highlights
                 # with their other highlights
-                self.set_win_option("wrap", self.options.wrap_output)
-                self.set_win_option("cursorline", False)
-                self.canvas.present()
+                self.set_win_option("wrap", self.options.wrap_output, batch)
+                self.set_win_option("cursorline", False, batch)
             else:  # move the current window
-                self.display_win.api.set_config(win_opts)
+                batch.add("nvim_win_set_config", self.display_win.handle, win_opts)
 
             if self.display_virt_lines is not None:
                 del self.display_virt_lines
@@ -438,7 +504,55 @@ class OutputBuffer:
                 self.display_virt_lines = DynamicPosition(
                     self.nvim, self.extmark_namespace, anchor.bufno, virt_lines_y, 0
                 )
-                self.display_virt_lines.set_height(virt_lines_height)
+                self.display_virt_lines.set_height(virt_lines_height, batch)
+
+        if own_batch:
+            batch.flush()
+            self.canvas.present()
+
+    def _write_display_buf(self, lines: List[str], batch: RpcBatch) -> None:
+        """Write the lines `build_output_text` returned for the float to `display_buf`, keeping
+        the lines it already has that didn't change, so a float showing a running cell only
+        redraws its new lines"""
+        text_lines = len(lines) - 1
+        if self.options.image_provider == "snacks.nvim":
+            text_lines -= 1
+        # the trailing empty lines removed from the text may not be there anymore
+        unchanged = min(self._float_text.changed_from, self._display_text_lines, text_lines)
+
+        if lines[0] != self._display_header:
+            batch.add("nvim_buf_set_lines", self.display_buf.handle, 0, 1, False, lines[:1])
+            self._display_header = lines[0]
+        if unchanged < self._display_lines or unchanged < len(lines) - 1:
+            batch.add(
+                "nvim_buf_set_lines",
+                self.display_buf.handle,
+                unchanged + 1,
+                -1,
+                False,
+                lines[unchanged + 1 :],
+            )
+            # the ansi colors of the lines that were replaced
+            batch.add(
+                "nvim_buf_clear_namespace",
+                self.display_buf.handle,
+                self.extmark_namespace,
+                unchanged + 1,
+                -1,
+            )
+            for lineno, start, end, style in self._float_text.highlights_between(
+                unchanged, text_lines
+            ):
+                batch.add(
+                    "nvim_buf_set_extmark",
+                    self.display_buf.handle,
+                    self.extmark_namespace,
+                    lineno + 1,
+                    start,
+                    {"end_col": end, "hl_group": ansi_group(style, batch), "strict": False},
+                )
+        self._display_lines = len(lines) - 1
+        self._display_text_lines = text_lines
 
     def set_border_highlight(self, border):
         hl = self.options.hl.border_norm
@@ -468,6 +582,23 @@ class OutputBuffer:
             self.display_win.api.set_config({"footer": ""})
 
 
+def _styled_chunks(
+    line: str, highlights: List[Highlight], hl: str, batch: RpcBatch
+) -> List[Tuple[str, Any]]:
+    """The virtual text chunks of a line with these highlights on it, in `hl` with the ansi
+    colors on top"""
+    chunks: List[Tuple[str, Any]] = []
+    col = 0
+    for _, start, end, style in highlights:
+        if start > col:
+            chunks.append((line[col:start], hl))
+        chunks.append((line[start:end], [hl, ansi_group(style, batch)]))
+        col = end
+    if col < len(line) or len(chunks) == 0:
+        chunks.append((line[col:], hl))
+    return chunks
+
+
 def border_size(border: Union[str, List[str], List[List[str]]]):
     width, height = 0, 0
     match border:
@@ -3,31 +3,57 @@ from typing import (
     Tuple,
     List,
     Dict,
+    Deque,
     Any,
     Callable,
     IO,
 )
+from collections import deque
 from contextlib import AbstractContextManager
+from itertools import islice
 from enum import Enum
 from abc import ABC, abstractmethod
-import re
+from bisect import bisect_left
+import sys
 from datetime import datetime
 
 from pynvim import Nvim
 
 
+from molten.ansi import (
+    ANSI_CODE_REGEX,
+    DEFAULT_STYLE,
+    Span,
+    Style,
+    collapse_sgr,
+    parse_ansi,
+)
 from molten.images import Canvas
 from molten.options import MoltenOptions
+from molten.retention import INDEX_INTERVAL, OutputRetention, SpillFile
 from molten.utils import notify_error
 
 
+# Shared by every chunk without metadata or extras, never modify it
+EMPTY_DICT: Dict[str, Any] = {}
+
+
 class OutputChunk(ABC):
-    jupyter_data: Optional[Dict[str, Any]] = None
-    jupyter_metadata: Optional[Dict[str, Any]] = None
+    # Long sessions keep many thousands of chunks around, slots keep them small
+    __slots__ = ("jupyter_data", "jupyter_metadata", "extras", "output_type")
+
+    jupyter_data: Optional[Dict[str, Any]]
+    jupyter_metadata: Optional[Dict[str, Any]]
     # extra keys that are used to write data to jupyter notebook files (ie. for error outputs)
-    extras: Dict[str, Any] = {}
+    extras: Dict[str, Any]
     output_type: str
 
+    def __init__(self, output_type: str = "display_data"):
+        self.jupyter_data = None
+        self.jupyter_metadata = None
+        self.extras = EMPTY_DICT
+        self.output_type = output_type
+
     @abstractmethod
     def place(
         self,
@@ -43,26 +69,78 @@ class OutputChunk(ABC):
         pass
 
 
-# Adapted from [https://stackoverflow.com/a/14693789/4803382]:
-ANSI_CODE_REGEX = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
-
-
 def clean_up_text(text: str) -> str:
     text = ANSI_CODE_REGEX.sub("", text)
     text = text.replace("\r\n", "\n")
     return text
 
 
+def parse_text(text: str, style: Style = DEFAULT_STYLE) -> Tuple[str, List[Span], Style]:
+    """Like `clean_up_text`, but keeping the styles the escape sequences set, see `parse_ansi`"""
+    plain, spans, style = parse_ansi(text.replace("\r\n", "\n"), style)
+    if "\r\n" in plain:
+        # a \r and a \n with an escape sequence in between, not worth moving the spans for
+        return plain.replace("\r\n", "\n"), [], style
+    return plain, spans, style
+
+
+# Layouts a text chunk remembers, one for the floating window and one for the virtual text
+LAYOUTS_PER_CHUNK = 2
+
+
 class TextOutputChunk(OutputChunk):
+    __slots__ = ("text", "_parsed", "_layouts")
+
     text: str
+    _parsed: Optional[Tuple[Any, str, List[Span]]]
+    """`text` when it was last parsed (the version of a stream), and what `parse_text` made of
+    it"""
+    _layouts: Optional[Dict[Tuple[int, int, bool, bool], Tuple[str, int, List["Highlight"]]]]
+    """what `layout` returned, by column, window width, `wrap_output` and hard wrapping"""
 
     def __init__(self, text: str):
+        super().__init__()
         self.text = text
-        self.output_type = "display_data"
+        self._parsed = None
+        self._layouts = None
 
     def __repr__(self) -> str:
         return f'TextOutputChunk("{self.text}")'
 
+    def parsed(self) -> Tuple[str, List[Span]]:
+        """The text without escape sequences and the spans of it that are styled. Parsed once,
+        not on every render"""
+        if self._parsed is None or self._parsed[0] is not self.text:
+            plain, spans, _ = parse_text(self.text)
+            self._parsed = (self.text, plain, spans)
+            self._layouts = None
+        return self._parsed[1], self._parsed[2]
+
+    def layout(
+        self,
+        options: MoltenOptions,
+        col: int,
+        shape: Tuple[int, int, int, int],
+        hard_wrap: bool,
+    ) -> Tuple[str, int, List["Highlight"]]:
+        """`place_styled_text` of the parsed text. Wrapped layouts are remembered until the text
+        changes, so showing a finished output again doesn't wrap it again"""
+        text, spans = self.parsed()
+        if not options.wrap_output and len(spans) == 0:
+            # nothing to lay out
+            return text, 0, []
+
+        key = (col, shape[2], options.wrap_output, hard_wrap)
+        if self._layouts is None:
+            self._layouts = {}
+        layout = self._layouts.get(key)
+        if layout is None:
+            layout = place_styled_text(text, spans, options, col, shape, hard_wrap)
+            if len(self._layouts) >= LAYOUTS_PER_CHUNK:
+                del self._layouts[next(iter(self._layouts))]
+            self._layouts[key] = layout
+        return layout
+
     def place(
         self,
         _bufnr: int,
@@ -74,53 +152,338 @@ class TextOutputChunk(OutputChunk):
         hard_wrap: bool,
         winnr: int | None = None,
     ) -> Tuple[str, int]:
-        text = clean_up_text(self.text)
-        extra_lines = 0
-        if options.wrap_output:  # count the number of extra lines this will need when wrapped
-            win_width = shape[2]
-            if hard_wrap:
-                lines = []
-                splits = []
-                # Assume this is a progress bar, or similar, we shouldn't try to wrap it
-                if text.find("\r") != -1:
-                    return text, 0
-                for line in text.split("\n"):
-                    index = 0
-                    if len(line) + col > win_width:
-                        splits.append(line[: win_width - col])
-                        line = line[win_width - col :]
-
-                    for _ in range(len(line) // win_width):
-                        splits.append(line[index * win_width : (index + 1) * win_width])
-                        index += 1
-                    splits.append(line[index * win_width :])
-
-                lines.extend(splits)
-                text = "\n".join(lines)
-            else:
-                for line in text.split("\n"):
-                    if len(line) > win_width:
-                        extra_lines += len(line) // win_width
-
+        text, extra_lines, _ = self.layout(options, col, shape, hard_wrap)
         return text, extra_lines
 
 
+Highlight = Tuple[int, int, int, Style]
+"""line, start and end column of some laid out text, and its style"""
+
+
+def _split_line(line: str, col: int, win_width: int) -> List[str]:
+    """Hard wrap a line that starts at column `col`"""
+    splits = []
+    index = 0
+    if len(line) + col > win_width:
+        splits.append(line[: win_width - col])
+        line = line[win_width - col :]
+
+    for _ in range(len(line) // win_width):
+        splits.append(line[index * win_width : (index + 1) * win_width])
+        index += 1
+    splits.append(line[index * win_width :])
+    return splits
+
+
+def place_styled_text(
+    text: str,
+    spans: List[Span],
+    options: MoltenOptions,
+    col: int,
+    shape: Tuple[int, int, int, int],
+    hard_wrap: bool,
+) -> Tuple[str, int, List[Highlight]]:
+    """Lay out text without escape sequences that starts at column `col`, with the spans of it that
+    are styled. Returns the text to display, the number of extra lines it takes up once soft
+    wrapped, and where the spans end up once wrapped, by line (counted from the first line of the
+    text) and column"""
+    win_width = shape[2]
+    # Assume this is a progress bar, or similar, we shouldn't try to wrap it
+    hard_wrapping = options.wrap_output and hard_wrap and text.find("\r") == -1
+    soft_wrapping = options.wrap_output and not hard_wrap
+    if not hard_wrapping and not soft_wrapping and len(spans) == 0:
+        return text, 0, []
+
+    placed: List[str] = []
+    extra_lines = 0
+    highlights: List[Highlight] = []
+    span_index = 0
+    offset = 0
+    for line in text.split("\n"):
+        pieces = _split_line(line, col, win_width) if hard_wrapping else [line]
+        if soft_wrapping and len(line) > win_width:
+            extra_lines += len(line) // win_width
+
+        for piece in pieces:
+            end = offset + len(piece)
+            while span_index < len(spans) and spans[span_index][1] <= offset:
+                span_index += 1
+            i = span_index
+            while i < len(spans) and spans[i][0] < end:
+                start, stop, style = spans[i]
+                start, stop = max(start, offset), min(stop, end)
+                if stop > start:
+                    highlights.append((len(placed), start - offset, stop - offset, style))
+                i += 1
+            placed.append(piece)
+            offset = end
+        offset += 1  # the new line
+
+    if not hard_wrapping:
+        # the same lines, no need for another copy of the text
+        return text, extra_lines, highlights
+    return "\n".join(placed), extra_lines, highlights
+
+
 class TextLnOutputChunk(TextOutputChunk):
+    __slots__ = ()
+
     def __init__(self, text: str):
         super().__init__(text + "\n")
 
 
+def _rewind_line(line: str, pending: bool = False) -> str:
+    """Remove the text on a line before a \\r, it's overwritten in a terminal. Only once something
+    is written after the \\r though, escape sequences alone don't erase anything (eg. a progress bar
+    that resets its color before the new line). With `pending`, the line isn't complete yet and a
+    \\r that nothing was written after is kept, along with the escape sequences after it"""
+    if "\r" not in line:
+        return line
+    segments = line.split("\r")
+    i = len(segments) - 1
+    while i > 0 and ANSI_CODE_REGEX.sub("", segments[i]) == "":
+        i -= 1
+
+    erased = "\r".join(segments[:i])
+    kept = segments[i]
+    if i < len(segments) - 1:
+        escapes = "".join(segments[i + 1 :])
+        kept += "\r" + escapes if pending else escapes
+    if "\x1b" in erased:
+        # the style it set still applies to what's written over it
+        return collapse_sgr(erased) + kept
+    return kept
+
+
+class StreamOutputChunk(TextOutputChunk):
+    """Text written to a stream (stdout or stderr) by consecutive `stream` messages. Instead of a
+    chunk per message, text is appended to this chunk, which stores it as a list of lines.
+
+    Like in a terminal, a \\r only rewinds the line it's on, so a progress bar redrawing itself
+    costs as much as the text of the update, however long the output before it is.
+
+    With a `retention`, only the first and the last lines are kept in memory, the ones in between
+    are spilled to a file and read back from it when they're needed (see `OutputRetention`)"""
+
+    __slots__ = (
+        "name",
+        "lines",
+        "spill",
+        "tail",
+        "last",
+        "retention",
+        "head_size",
+        "tail_size",
+        "version",
+        "_text",
+        "__weakref__",
+    )
+
+    name: str
+    lines: List[str]
+    """the complete lines at the start of the text, all of them without a retention. Text before a
+    \\r is already removed"""
+    spill: Optional[SpillFile]
+    """the complete lines after `lines` that were moved out of memory"""
+    tail: Deque[str]
+    """the complete lines after the spilled ones"""
+    last: str
+    """the unterminated (possibly empty) line. It can still have a \\r, followed by nothing but
+    escape sequences, which only rewinds the line once text is written after it, see
+    `shown_last`"""
+    retention: Optional[OutputRetention]
+    head_size: int
+    """characters in `lines`, new lines included"""
+    tail_size: int
+    """characters in `tail`, new lines included"""
+    version: int
+    """bumped when text is appended"""
+    _text: Optional[Tuple[int, str]]
+    """`text` and the version it was built at. Not kept once lines are spilled, it would bring them
+    all back into memory"""
+
+    def __init__(self, name: str, text: str, retention: Optional[OutputRetention] = None):
+        # not OutputChunk.__init__, `jupyter_data` is computed from the lines
+        self.jupyter_metadata = EMPTY_DICT
+        self.extras = EMPTY_DICT
+        self.output_type = "display_data"
+        self.name = name
+        self.lines = []
+        self.spill = None
+        self.tail = deque()
+        self.last = ""
+        self.retention = retention
+        self.head_size = 0
+        self.tail_size = 0
+        self.version = 0
+        self._text = None
+        self._parsed = None
+        self._layouts = None
+        if retention is not None:
+            retention.track(self)
+        self.append(text)
+
+    def __del__(self) -> None:
+        if self.retention is not None:
+            self.retention.used -= self.head_size + self.tail_size
+        if self.spill is not None:
+            self.spill.remove()
+
+    def __repr__(self) -> str:
+        return f'StreamOutputChunk("{self.name}", "{self.text}")'
+
+    def append(self, text: str) -> None:
+        new_lines = text.replace("\r\n", "\n").split("\n")
+        # a \r\n split between two messages ends the line without rewinding it
+        new_lines[0] = self.last + new_lines[0]
+
+        self.last = _rewind_line(new_lines.pop(), pending=True)
+        if len(new_lines) > 0:
+            self._keep([_rewind_line(line) for line in new_lines])
+        self.version += 1
+        self._text = None
+
+    def _keep(self, lines: List[str]) -> None:
+        """Store new complete lines"""
+        retention = self.retention
+        if retention is None:
+            self.lines.extend(lines)
+            return
+
+        added = 0
+        i = 0
+        if self.spill is None and len(self.tail) == 0:
+            head_chars = retention.head_chars
+            while i < len(lines) and self.head_size + added < head_chars:
+                added += len(lines[i]) + 1
+                i += 1
+            self.lines.extend(lines[:i])
+            self.head_size += added
+        for line in lines[i:]:
+            self.tail.append(line)
+            self.tail_size += len(line) + 1
+            added += len(line) + 1
+
+        retention.used += added
+        if self.tail_size > retention.tail_chars:
+            self.spill_tail(retention.tail_chars)
+        retention.enforce()
+
+    def spill_tail(self, keep: int) -> None:
+        """Move the oldest lines of the tail to the spill file, until it's at most `keep`
+        characters"""
+        assert self.retention is not None
+        spilled = []
+        size = self.tail_size
+        while size > keep and len(self.tail) > 0:
+            line = self.tail.popleft()
+            spilled.append(line)
+            size -= len(line) + 1
+        if len(spilled) > 0:
+            if self.spill is None:
+                self.spill = SpillFile(self.retention.alloc_file)
+            self.spill.append(spilled)
+            self._text = None
+        self.retention.used -= self.tail_size - size
+        self.tail_size = size
+
+    def spill_head(self) -> None:
+        """Move the first lines to the spill file as well, in front of the lines already in it"""
+        assert self.retention is not None
+        if self.head_size == 0:
+            return
+        spill = SpillFile(self.retention.alloc_file)
+        spill.append(self.lines)
+        if self.spill is not None:
+            # a few blocks at a time, the point is not to have all of them in memory
+            step = INDEX_INTERVAL * 64
+            for start in range(0, len(self.spill), step):
+                spill.append(self.spill.read(start, start + step))
+            self.spill.remove()
+        self.spill = spill
+        self.lines = []
+        self.retention.used -= self.head_size
+        self.head_size = 0
+        self._text = None
+
+    @property
+    def line_count(self) -> int:
+        """number of complete lines"""
+        return len(self.lines) + (len(self.spill) if self.spill is not None else 0) + len(self.tail)
+
+    def get_lines(self, start: int, end: int) -> List[str]:
+        """The complete lines from `start` up to `end`, read back from the spill file if needed"""
+        found = self.lines[start:end]
+        start -= len(self.lines)
+        end -= len(self.lines)
+        if self.spill is not None:
+            spilled = len(self.spill)
+            if end > 0 and start < spilled:
+                found += self.spill.read(max(start, 0), min(end, spilled))
+            start -= spilled
+            end -= spilled
+        if end > 0 and len(self.tail) > 0:
+            start, end = max(start, 0), min(end, len(self.tail))
+            if start > len(self.tail) - end:
+                # closer to the end, where new lines are read from
+                n = len(self.tail)
+                from_end = list(islice(reversed(self.tail), n - end, n - start))
+                from_end.reverse()
+                found += from_end
+            else:
+                found += islice(self.tail, start, end)
+        return found
+
+    @property
+    def shown_last(self) -> str:
+        """the unterminated line as it's shown, without a \\r that's still pending"""
+        return _rewind_line(self.last)
+
+    @property
+    def text(self) -> str:  # type: ignore
+        if self._text is not None and self._text[0] == self.version:
+            return self._text[1]
+        last = self.shown_last
+        text = "\n".join(self.get_lines(0, self.line_count) + [last])
+        if last != "":
+            # like TextLnOutputChunk, end on a new line so the next chunk starts on its own line
+            text += "\n"
+        if self.spill is None:
+            self._text = (self.version, text)
+        return text
+
+    def parsed(self) -> Tuple[str, List[Span]]:
+        # `text` isn't the same string every time once lines are spilled, the version tells
+        # whether it changed
+        if self._parsed is None or self._parsed[0] != self.version:
+            plain, spans, _ = parse_text(self.text)
+            self._parsed = (self.version, plain, spans)
+            self._layouts = None
+        return self._parsed[1], self._parsed[2]
+
+    @property
+    def jupyter_data(self) -> Dict[str, Any]:  # type: ignore
+        text = self.text
+        return {"text/plain": text[:-1] if self.shown_last != "" else text}
+
+
 class BadOutputChunk(TextLnOutputChunk):
+    __slots__ = ()
+
     def __init__(self, mimetypes: List[str]):
         super().__init__("<No usable MIMEtype! Received mimetypes %r>" % mimetypes)
 
 
 class MimetypesOutputChunk(TextLnOutputChunk):
+    __slots__ = ()
+
     def __init__(self, mimetypes: List[str]):
         super().__init__("[DEBUG] Received mimetypes: %r" % mimetypes)
 
 
 class ErrorOutputChunk(TextLnOutputChunk):
+    __slots__ = ()
+
     def __init__(self, name: str, message: str, traceback: List[str]):
         super().__init__(
             "\n".join(
@@ -135,14 +498,18 @@ class ErrorOutputChunk(TextLnOutputChunk):
 
 
 class AbortedOutputChunk(TextLnOutputChunk):
+    __slots__ = ()
+
     def __init__(self) -> None:
         super().__init__("<Kernel aborted with no error message.>")
 
 
 class ImageOutputChunk(OutputChunk):
+    __slots__ = ("img_path", "img_identifier")
+
     def __init__(self, img_path: str):
+        super().__init__()
         self.img_path = img_path
-        self.output_type = "display_data"
         self.img_identifier = None
 
     def place(
@@ -185,6 +552,19 @@ class OutputStatus(Enum):
 
 
 class Output:
+    __slots__ = (
+        "execution_count",
+        "chunks",
+        "status",
+        "success",
+        "old",
+        "start_time",
+        "end_time",
+        "version",
+        "rewrites",
+        "_should_clear",
+    )
+
     execution_count: Optional[int]
     chunks: List[OutputChunk]
     status: OutputStatus
@@ -192,6 +572,11 @@ class Output:
     old: bool
     start_time: datetime | None
     end_time: datetime | None
+    version: int
+    """bumped on every change to `chunks`, so displays can tell when they need to redraw"""
+    rewrites: int
+    """bumped when chunks that were already there change or go away, rather than new text being
+    added at the end, so `OutputText` knows to lay the output out again from the start"""
 
     _should_clear: bool
 
@@ -204,23 +589,369 @@ class Output:
 
         self.start_time = None
         self.end_time = None
+        self.version = 0
+        self.rewrites = 0
 
         self._should_clear = False
 
+    def append_chunk(self, chunk: OutputChunk) -> None:
+        self.chunks.append(chunk)
+        self.version += 1
+
+    def clear_chunks(self) -> None:
+        self.chunks.clear()
+        self.version += 1
+        self.rewrites += 1
+
+    def append_stream(
+        self, name: str, text: str, retention: Optional[OutputRetention] = None
+    ) -> None:
+        """Append the text of a `stream` message, extending the last chunk when it's text from the
+        same stream. A new chunk keeps as much of its text in memory as `retention` allows"""
+        last = self.chunks[-1] if len(self.chunks) > 0 else None
+        if isinstance(last, StreamOutputChunk) and last.name == name:
+            last.append(text)
+        else:
+            last = StreamOutputChunk(name, text, retention)
+            self.chunks.append(last)
+
+        self.version += 1
+
     def merge_text_chunks(self):
         """Merge the last two chunks if they are text chunks, and text on a line before \r
-        character, this is b/c outputs before a \r aren't shown, and so, should be deleted"""
+        character, this is b/c outputs before a \r aren't shown, and so, should be deleted.
+        Stream chunks aren't merged into, `append_stream` takes care of them"""
         if (
             len(self.chunks) >= 2
             and isinstance((c1 := self.chunks[-2]), TextOutputChunk)
+            and not isinstance(c1, StreamOutputChunk)
             and isinstance((c2 := self.chunks[-1]), TextOutputChunk)
         ):
-            c1.text += c2.text
-            c1.text = "\n".join([re.sub(r".*\r", "", x) for x in c1.text.split("\n")[:-1]])
+            # only the last line of c1 is rewound by c2, the lines before it are left alone
+            head, newline, last = c1.text.rpartition("\n")
+            if "\r" in head:
+                head = "\n".join([_rewind_line(x) for x in head.split("\n")])
+            lines = [_rewind_line(x) for x in (last + c2.text).split("\n")[:-1]]
+            c1.text = head + newline + "\n".join(lines) if len(lines) > 0 else head
             c1.jupyter_data = {"text/plain": c1.text}
             self.chunks.pop()
-        elif len(self.chunks) > 0 and isinstance((c1 := self.chunks[0]), TextOutputChunk):
-            c1.text = "\n".join([re.sub(r".*\r", "", x) for x in c1.text.split("\n")[:-1]])
+            self.version += 1
+            self.rewrites += 1
+        elif (
+            len(self.chunks) > 0
+            and isinstance((c1 := self.chunks[0]), TextOutputChunk)
+            and not isinstance(c1, StreamOutputChunk)
+        ):
+            c1.text = "\n".join([_rewind_line(x) for x in c1.text.split("\n")[:-1]])
+            self.version += 1
+            self.rewrites += 1
+
+
+# Lines of a stream laid out at once, see `OutputText.build`
+STREAM_LAYOUT_LINES = 1000
+
+
+class OutputText:
+    """The text of an output as laid out in one of its displays (the floating window or the virtual
+    lines), kept as a list of lines that grows as chunks arrive instead of being rebuilt from every
+    chunk on each render. While a stream is being written to, only its lines that are new since
+    the last render are laid out.
+
+    The layout depends on the width of the window, so each display keeps its own. It starts over
+    when the width or the output changes, or when chunks that were already laid out are rewritten
+    (see `Output.rewrites`)."""
+
+    output: Optional[Output]
+    key: Optional[Tuple[Any, ...]]
+
+    lines: List[str]
+    """the laid out text split on newlines, the last entry is the unterminated line"""
+    length: int
+    """length of the laid out text, newlines included"""
+    extra_lines: int
+    """lines taken up by soft wrapping the laid out text"""
+    placed: int
+    """number of chunks that are completely laid out"""
+    stream_lines: int
+    """complete lines already laid out of chunk `placed`, the stream that's still being written"""
+    stream_col: int
+    """the column that stream started at"""
+    images: List[Tuple[ImageOutputChunk, int]]
+    """laid out image chunks with the line they start on, the canvas needs them on every render"""
+    stream_style: Style
+    """the style at the end of the lines of that stream laid out so far"""
+    highlights: List[Highlight]
+    """where the laid out text is styled, in order"""
+    changed_from: int
+    """the lines `build` returned before this one are the same as the last time it was called"""
+    lines_total: int
+    """number of lines of the whole output `build` laid out last, without trailing empty lines"""
+    _tail_highlights: List[Highlight]
+    _cut: Optional[Tuple[int, int]]
+    """line and column where the text is truncated, once it's past the limit"""
+    _shown_lines: int
+    """lines of text `build` returned last, without the note that it was truncated"""
+
+    def __init__(self) -> None:
+        self.output = None
+        self.key = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self.lines = [""]
+        self.length = 0
+        self.extra_lines = 0
+        self.placed = 0
+        self.stream_lines = 0
+        self.stream_col = 0
+        self.stream_style = DEFAULT_STYLE
+        self.images = []
+        self.highlights = []
+        self.changed_from = 0
+        self.lines_total = 0
+        self._tail_highlights = []
+        self._cut = None
+        self._shown_lines = 0
+
+    def _append(self, text: str, highlights: List[Highlight]) -> None:
+        self.highlights.extend(self._move_highlights(highlights))
+        new_lines = text.split("\n")
+        self.lines[-1] += new_lines[0]
+        self.lines.extend(new_lines[1:])
+        self.length += len(text)
+
+    def _move_highlights(self, highlights: List[Highlight]) -> List[Highlight]:
+        """Highlights of text about to be appended, from where they are in that text to where
+        they'll be in `lines`"""
+        line = len(self.lines) - 1
+        col = len(self.lines[-1])
+        return [
+            (line + l, start + col, end + col, style) if l == 0 else (line + l, start, end, style)
+            for l, start, end, style in highlights
+        ]
+
+    def highlights_between(self, start: int, end: int) -> List[Highlight]:
+        """The highlights on the lines from `start` up to `end` of what `build` returned last"""
+        end = min(end, self._shown_lines)
+        found = []
+        i = bisect_left(self.highlights, start, key=lambda highlight: highlight[0])
+        while i < len(self.highlights) and self.highlights[i][0] < end:
+            found.append(self.highlights[i])
+            i += 1
+        found.extend(h for h in self._tail_highlights if start <= h[0] < end)
+        return found
+
+    @property
+    def col(self) -> int:
+        # one past the end of the last line after the first chunk, as it's always been passed to
+        # `place`
+        return 0 if self.placed == 0 else len(self.lines[-1]) + 1
+
+    def build(
+        self,
+        output: Output,
+        bufnr: int,
+        options: MoltenOptions,
+        shape: Tuple[int, int, int, int],
+        canvas: Canvas,
+        virtual: bool,
+        winnr: int | None = None,
+        max_lines: int = 0,
+    ) -> Tuple[List[str], int]:
+        """Lay out the chunks added since the last call. Returns the lines of the whole output,
+        truncated to `limit_output_chars`, and the number of virtual lines its images and soft
+        wrapped lines take up. With `max_lines`, only that many lines are returned, see
+        `lines_total` for how many there are"""
+        limit = options.limit_output_chars
+        key = (
+            output.rewrites,
+            shape[2],
+            virtual,
+            options.wrap_output,
+            options.image_location,
+            limit,
+        )
+        if output is not self.output or key != self.key:
+            self.output = output
+            self.key = key
+            self._reset()
+        else:
+            # text is only ever added to the last line, or after it
+            self.changed_from = len(self.lines) - 1
+
+        # images laid out by earlier calls are put back on the canvas, they may have moved
+        virtual_lines = 0
+        for chunk, lineno in self.images:
+            _, virt_lines = chunk.place(
+                bufnr, options, 0, shape[1] if virtual else lineno, shape, canvas, virtual, winnr
+            )
+            virtual_lines += virt_lines
+
+        chunks = output.chunks
+        tail = ""
+        tail_extra_lines = 0
+        self._tail_highlights = []
+        while self.placed < len(chunks):
+            chunk = chunks[self.placed]
+            # text past the limit is never shown, it's not worth laying out or keeping around
+            hidden = limit and self.length > limit
+            if isinstance(chunk, StreamOutputChunk):
+                if self.stream_lines == 0:
+                    self.stream_col = self.col
+                    self.stream_style = DEFAULT_STYLE
+                complete = chunk.line_count
+                # the lines of a stream never have a \r in them (see `StreamOutputChunk.lines`),
+                # which `place_styled_text` would have to see all of the text to not wrap
+                while self.stream_lines < complete and not hidden:
+                    # a few lines at a time, the ones past the limit may not have to be read
+                    end = min(complete, self.stream_lines + STREAM_LAYOUT_LINES)
+                    lines = chunk.get_lines(self.stream_lines, end)
+                    text, spans, style = parse_text("\n".join(lines) + "\n", self.stream_style)
+                    if limit and self.length + len(text) > limit:
+                        # only up to the line that goes past the limit, however the lines were
+                        # split between calls
+                        self._append_stream_lines(lines, limit, options, shape, virtual)
+                        hidden = True
+                        break
+                    self.stream_style = style
+                    text, extra_lines, highlights = place_styled_text(
+                        text, spans, options, self.stream_col, shape, virtual
+                    )
+                    self._append(text, highlights)
+                    self.extra_lines += extra_lines
+                    self.stream_lines = end
+                    hidden = limit and self.length > limit
+                self.stream_lines = complete
+
+                last = chunk.shown_last
+                if last != "" and not hidden:
+                    # like `StreamOutputChunk.text`, the unterminated line ends on a new line
+                    text, spans, _ = parse_text(last + "\n", self.stream_style)
+                    text, extra_lines, highlights = place_styled_text(
+                        text, spans, options, self.stream_col, shape, virtual
+                    )
+                    if self.placed == len(chunks) - 1:
+                        # it's still being written to, lay it out again next time
+                        tail, tail_extra_lines = text, extra_lines
+                        self._tail_highlights = self._move_highlights(highlights)
+                        break
+                    self._append(text, highlights)
+                    self.extra_lines += extra_lines
+                elif self.placed == len(chunks) - 1:
+                    break
+                self.stream_lines = 0
+            elif isinstance(chunk, TextOutputChunk):
+                if hidden:
+                    self.placed += 1
+                    continue
+                text, extra_lines, highlights = chunk.layout(options, self.col, shape, virtual)
+                self._append(text, highlights)
+                self.extra_lines += extra_lines
+            else:
+                lineno = len(self.lines)
+                text, virt_lines = chunk.place(
+                    bufnr,
+                    options,
+                    self.col,
+                    shape[1] if virtual else lineno,
+                    shape,
+                    canvas,
+                    virtual,
+                    winnr,
+                )
+                self._append(text, [])
+                if isinstance(chunk, ImageOutputChunk):
+                    self.images.append((chunk, lineno))
+                    virtual_lines += virt_lines
+                else:
+                    self.extra_lines += virt_lines
+            self.placed += 1
+
+        return (
+            self._compose(tail, limit, max_lines),
+            virtual_lines + self.extra_lines + tail_extra_lines,
+        )
+
+    def _append_stream_lines(
+        self,
+        lines: List[str],
+        limit: int,
+        options: MoltenOptions,
+        shape: Tuple[int, int, int, int],
+        virtual: bool,
+    ) -> None:
+        """Lay out the lines of a stream one by one, until the text is past `limit`"""
+        for line in lines:
+            text, spans, self.stream_style = parse_text(line + "\n", self.stream_style)
+            text, extra_lines, highlights = place_styled_text(
+                text, spans, options, self.stream_col, shape, virtual
+            )
+            self._append(text, highlights)
+            self.extra_lines += extra_lines
+            if self.length > limit:
+                return
+
+    def _compose(self, tail: str, limit: int, max_lines: int) -> List[str]:
+        """The lines of the laid out text followed by `tail`, truncated to `limit` characters, only
+        the first `max_lines` of them if it's given. Sets `lines_total`"""
+        n = len(self.lines)
+        tail_lines = tail.split("\n")
+        cut = None
+        if limit and self.length + len(tail) > limit:
+            if self._cut is None and self.length > limit:
+                # it's in the text that's laid out for good, it won't move anymore
+                self._cut = _find_cut(self.lines, limit)
+            cut = self._cut
+            if cut is None:
+                # somewhere in the last line or the tail
+                start = self.length - len(self.lines[-1])
+                last_lines = [self.lines[-1] + tail_lines[0]] + tail_lines[1:]
+                line, col = _find_cut(last_lines, limit - start)
+                cut = (n - 1 + line, col)
+            total = cut[0] + 3  # the note that it was truncated, and an empty line
+        else:
+            total = n + len(tail_lines) - 1
+
+        count = min(total, max_lines) if max_lines else total
+        lines = self.lines[:count]
+        if count >= n and tail != "":
+            lines[n - 1] += tail_lines[0]
+            lines.extend(tail_lines[1 : 1 + count - n])
+        if cut is not None and count > cut[0]:
+            lines[cut[0]] = lines[cut[0]][: cut[1]]
+            del lines[cut[0] + 1 :]
+            lines.extend([f"...truncated to {limit} chars", ""][: count - cut[0] - 1])
+            self.changed_from = min(self.changed_from, cut[0])
+            self._shown_lines = cut[0] + 1
+        else:
+            self._shown_lines = len(lines)
+
+        # without trailing empty lines
+        if cut is not None:
+            self.lines_total = total - 1
+        else:
+            self.lines_total = total
+            while self.lines_total > 0 and self._line(self.lines_total - 1, tail_lines) == "":
+                self.lines_total -= 1
+        return lines
+
+    def _line(self, i: int, tail_lines: List[str]) -> str:
+        """Line `i` of the laid out text followed by the tail"""
+        n = len(self.lines)
+        if i < n - 1:
+            return self.lines[i]
+        if i == n - 1:
+            return self.lines[-1] + tail_lines[0]
+        return tail_lines[i - n + 1]
+
+
+def _find_cut(lines: List[str], limit: int) -> Tuple[int, int]:
+    """The line and column where the first `limit` characters of the text `lines` make up end"""
+    for i, line in enumerate(lines):
+        if limit <= len(line):
+            return i, limit
+        limit -= len(line) + 1
+    return len(lines) - 1, len(lines[-1])
 
 
 def to_outputchunk(
@@ -322,7 +1053,8 @@ def to_outputchunk(
                 data = {}
             chunk = BadOutputChunk(list(data.keys()))
 
-    chunk.jupyter_data = data
-    chunk.jupyter_metadata = metadata
+    # the same few mimetypes come with every message, share the key strings between chunks
+    chunk.jupyter_data = {sys.intern(mimetype): value for mimetype, value in data.items()}
+    chunk.jupyter_metadata = metadata if metadata else EMPTY_DICT
 
     return chunk
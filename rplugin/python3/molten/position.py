@@ -1,8 +1,69 @@
-from typing import List
+from contextlib import contextmanager
+from typing import Dict, Generator, List, Optional, Tuple
 from pynvim import Nvim
+from pynvim.api import NvimError
+
+from molten.batch import RpcBatch
+
+# (bufno, namespace) -> extmark id -> [row, col], while a position_snapshot is active
+_snapshot: Optional[Dict[Tuple[int, int], Dict[int, List[int]]]] = None
+# number of position_snapshot blocks entered, identifies the active one
+_snapshot_count = 0
+
+
+@contextmanager
+def position_snapshot() -> Generator[None, None, None]:
+    """Serve DynamicPosition reads from a single `nvim_buf_get_extmarks` call per buffer, instead of
+    one RPC per `lineno`/`colno`, for the duration of the block.
+
+    Only use this around code that doesn't edit the buffers it reads positions from, marks moved by
+    an edit inside the block would be read from before the edit. A new block (ie. the next tick,
+    cursor move or frame) always starts from a fresh snapshot. Nested blocks share the outer one."""
+    global _snapshot, _snapshot_count
+    if _snapshot is not None:
+        yield
+        return
+
+    _snapshot = {}
+    _snapshot_count += 1
+    try:
+        yield
+    finally:
+        _snapshot = None
+
+
+def current_snapshot() -> Optional[int]:
+    """Identifies the active position_snapshot block, None outside of one. Whatever is read about a
+    buffer inside a block stays true until the block ends, this lets caches know when that is"""
+    return _snapshot_count if _snapshot is not None else None
+
+
+# (nvim, bufno, namespace, extmark id) of the DynamicPositions collected since the last flush
+_pending_deletions: List[Tuple[Nvim, int, int, int]] = []
+
+
+def flush_extmark_deletions() -> None:
+    """Delete the extmarks of garbage collected DynamicPositions in one round trip. `nvimui` calls
+    this once every handler is done, so dropping thousands of cells costs a single RPC, and the
+    collector never talks to nvim in the middle of something else"""
+    global _pending_deletions
+    if len(_pending_deletions) == 0:
+        return
+
+    pending, _pending_deletions = _pending_deletions, []
+    batch = RpcBatch(pending[0][0])
+    for _, bufno, namespace, extmark_id in pending:
+        batch.add("nvim_buf_del_extmark", bufno, namespace, extmark_id)
+    try:
+        batch.flush()
+    except NvimError:
+        # the buffer was wiped, and its extmarks with it
+        pass
 
 
 class Position:
+    __slots__ = ("bufno", "lineno", "colno")
+
     bufno: int
     lineno: int
     colno: int
@@ -20,6 +81,8 @@ class Position:
 
 
 class DynamicPosition(Position):
+    __slots__ = ("nvim", "extmark_namespace", "extmark_id")
+
     nvim: Nvim
     extmark_namespace: int
     bufno: int
@@ -47,18 +110,26 @@ class DynamicPosition(Position):
             {"right_gravity": right_gravity, "strict": False},
         )
 
-    def set_height(self, height: int) -> None:
-        self.nvim.funcs.nvim_buf_set_extmark(
+    def set_height(self, height: int, batch: Optional[RpcBatch] = None) -> None:
+        lineno, colno = self._get_pos()
+        args = (
             self.bufno,
             self.extmark_namespace,
-            self.lineno,
-            self.colno,
+            lineno,
+            colno,
             {"id": self.extmark_id, "virt_lines": [[("", "Normal")] for _ in range(height)]},
         )
+        if batch is not None:
+            batch.add("nvim_buf_set_extmark", *args)
+        else:
+            self.nvim.funcs.nvim_buf_set_extmark(*args)
 
     def __del__(self) -> None:
-        # Note, this will not fail if the extmark doesn't exist
-        self.nvim.funcs.nvim_buf_del_extmark(self.bufno, self.extmark_namespace, self.extmark_id)
+        # Deleted in a batch by flush_extmark_deletions. Note, this will not fail if the extmark
+        # doesn't exist
+        _pending_deletions.append((self.nvim, self.bufno, self.extmark_namespace, self.extmark_id))
+        if _snapshot is not None:
+            _snapshot.get((self.bufno, self.extmark_namespace), {}).pop(self.extmark_id, None)
 
     def __str__(self) -> str:
         return f"DynamicPosition({self.bufno}, {self.lineno}, {self.colno})"
@@ -67,6 +138,25 @@ class DynamicPosition(Position):
         return f"DynamicPosition(bufno={self.bufno}, lineno={self.lineno}, colno={self.colno})"
 
     def _get_pos(self) -> List[int]:
+        if _snapshot is not None:
+            key = (self.bufno, self.extmark_namespace)
+            marks = _snapshot.get(key)
+            if marks is None:
+                marks = {
+                    extmark_id: [row, col]
+                    for extmark_id, row, col in self.nvim.funcs.nvim_buf_get_extmarks(
+                        self.bufno, self.extmark_namespace, 0, -1, {}
+                    )
+                }
+                _snapshot[key] = marks
+            pos = marks.get(self.extmark_id)
+            if pos is None:
+                # created after the snapshot was taken
+                pos = marks[self.extmark_id] = self._fetch_pos()
+            return pos
+        return self._fetch_pos()
+
+    def _fetch_pos(self) -> List[int]:
         out = self.nvim.funcs.nvim_buf_get_extmark_by_id(
             self.bufno, self.extmark_namespace, self.extmark_id, {}
         )
@@ -0,0 +1,71 @@
+import time
+from typing import TYPE_CHECKING, Dict, Optional
+
+from pynvim import Nvim
+
+from molten.options import MoltenOptions
+
+if TYPE_CHECKING:
+    from molten.moltenbuffer import MoltenKernel
+
+
+class RenderScheduler:
+    """Coalesces interface updates into at most `render_fps` frames per second.
+
+    Kernels mark themselves dirty instead of redrawing right away. The first request after a quiet
+    period is drawn immediately, so a single cursor move or output still shows up without delay.
+    Requests that arrive within a frame of the last draw are merged into one draw at the end of
+    that frame, however many ticks and cursor moves happened in between."""
+
+    nvim: Nvim
+    options: MoltenOptions
+
+    dirty: Dict[str, "MoltenKernel"]
+    """kernels waiting for the next frame, by kernel id"""
+    last_frame: float
+    """`time.monotonic()` of the last draw"""
+    timer: Optional[int]
+    """the MoltenRenderFrame timer, while a draw is scheduled"""
+
+    def __init__(self, nvim: Nvim, options: MoltenOptions):
+        self.nvim = nvim
+        self.options = options
+        self.dirty = {}
+        self.last_frame = 0.0
+        self.timer = None
+
+    def mark_dirty(self, kernel: "MoltenKernel") -> None:
+        if self.options.render_fps <= 0:
+            kernel.update_interface()
+            return
+
+        self.dirty[kernel.kernel_id] = kernel
+        if self.timer is not None:
+            # already waiting for the end of the frame
+            return
+
+        frame_time = 1 / self.options.render_fps
+        wait = self.last_frame + frame_time - time.monotonic()
+        if wait <= 0:
+            self.flush()
+        else:
+            self.timer = self.nvim.funcs.timer_start(int(wait * 1000) + 1, "MoltenRenderFrame")
+
+    def discard(self, kernel: "MoltenKernel") -> None:
+        """Forget a pending draw, because the kernel was just drawn (or deinitialized)"""
+        self.dirty.pop(kernel.kernel_id, None)
+
+    def flush(self) -> None:
+        self.timer = None
+        self.last_frame = time.monotonic()
+
+        dirty = self.dirty
+        self.dirty = {}
+        for kernel in dirty.values():
+            kernel.update_interface()
+
+    def deinit(self) -> None:
+        if self.timer is not None:
+            self.nvim.funcs.timer_stop(self.timer)
+            self.timer = None
+        self.dirty = {}
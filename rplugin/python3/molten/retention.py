@@ -0,0 +1,149 @@
+import mmap
+import os
+import sys
+from array import array
+from contextlib import AbstractContextManager
+from typing import IO, TYPE_CHECKING, Callable, List, Optional, Tuple
+from weakref import WeakSet
+
+from molten.options import MoltenOptions
+
+if TYPE_CHECKING:
+    from molten.outputchunks import StreamOutputChunk
+
+AllocFile = Callable[[str, str], "AbstractContextManager[Tuple[str, IO[bytes]]]"]
+
+
+# Lines between two entries of the index of a SpillFile. Finding a line means scanning at most this
+# many lines from the closest entry, the index stays small even for millions of lines
+INDEX_INTERVAL = 64
+
+# Share of `output_memory_per_kernel` a kernel's streams are brought back to once they go over it.
+# Spilling a bit more than needed means it's a while before they have to be sorted again
+LOW_WATER = 0.75
+
+
+class SpillFile:
+    """Lines written to an append-only file, read back by their index when they're needed again.
+    The file is memory mapped for reading, so only the pages that are read are loaded, and the
+    page cache can drop them again. In memory, there's only the offset of every
+    `INDEX_INTERVAL`th line"""
+
+    path: str
+    count: int
+    """number of lines in the file"""
+    size: int
+    """bytes written to the file"""
+    offsets: "array[int]"
+    """where lines 0, INDEX_INTERVAL, 2 * INDEX_INTERVAL, ... start in the file"""
+    _map: Optional[mmap.mmap]
+
+    def __init__(self, alloc_file: AllocFile):
+        with alloc_file("txt", "wb") as (path, _):
+            pass
+        self.path = path
+        self.count = 0
+        self.size = 0
+        self.offsets = array("q")
+        self._map = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, lines: List[str]) -> None:
+        data = bytearray()
+        for line in lines:
+            if self.count % INDEX_INTERVAL == 0:
+                self.offsets.append(self.size + len(data))
+            data += line.encode("utf-8", "surrogatepass")
+            data += b"\n"
+            self.count += 1
+        with open(self.path, "ab") as file:
+            file.write(data)
+        self.size += len(data)
+
+    def _view(self) -> mmap.mmap:
+        if self._map is None or len(self._map) < self.size:
+            # lines were appended since it was mapped
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, "rb") as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _offset(self, view: mmap.mmap, index: int) -> int:
+        """Where line `index` starts in the file"""
+        if index >= self.count:
+            return self.size
+        offset = self.offsets[index // INDEX_INTERVAL]
+        for _ in range(index % INDEX_INTERVAL):
+            offset = view.find(b"\n", offset) + 1
+        return offset
+
+    def read(self, start: int, end: int) -> List[str]:
+        """The lines from `start` up to `end`"""
+        end = min(end, self.count)
+        if start >= end:
+            return []
+        view = self._view()
+        data = view[self._offset(view, start) : self._offset(view, end)]
+        return data.decode("utf-8", "surrogatepass").split("\n")[:-1]
+
+    def remove(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class OutputRetention:
+    """How much of the text streamed to the outputs of one kernel stays in memory.
+
+    A stream keeps its first `head_chars` characters, which are what the output window shows,
+    and its last `tail_chars` characters in a ring buffer. The lines in between are spilled to a
+    `SpillFile`. When the streams of all the outputs of the kernel hold more than
+    `output_memory_per_kernel` characters, the tails of the largest ones are spilled as well, and
+    then their heads, until they're back under `LOW_WATER` of it"""
+
+    options: MoltenOptions
+    alloc_file: AllocFile
+    used: int
+    """characters of stream text held in memory"""
+    _chunks: "WeakSet[StreamOutputChunk]"
+
+    def __init__(self, options: MoltenOptions, alloc_file: AllocFile):
+        self.options = options
+        self.alloc_file = alloc_file
+        self.used = 0
+        self._chunks = WeakSet()
+
+    @property
+    def head_chars(self) -> int:
+        budget = self.options.output_memory_per_cell
+        return budget // 2 if budget > 0 else sys.maxsize
+
+    @property
+    def tail_chars(self) -> int:
+        budget = self.options.output_memory_per_cell
+        return budget - budget // 2 if budget > 0 else sys.maxsize
+
+    def track(self, chunk: "StreamOutputChunk") -> None:
+        self._chunks.add(chunk)
+
+    def enforce(self) -> None:
+        """Spill the largest tails, then the largest heads, once the kernel is over its budget"""
+        budget = self.options.output_memory_per_kernel
+        if budget <= 0 or self.used <= budget:
+            return
+        target = int(budget * LOW_WATER)
+        for chunk in sorted(self._chunks, key=lambda chunk: chunk.tail_size, reverse=True):
+            if self.used <= target or chunk.tail_size == 0:
+                break
+            chunk.spill_tail(max(0, chunk.tail_size - (self.used - target)))
+        if self.used <= target:
+            return
+        for chunk in sorted(self._chunks, key=lambda chunk: chunk.head_size, reverse=True):
+            if self.used <= target or chunk.head_size == 0:
+                break
+            chunk.spill_head()
@@ -1,10 +1,13 @@
 from datetime import datetime
-from typing import Optional, Tuple, List, Dict, Generator, IO, Any
+from typing import Callable, Optional, Tuple, List, Dict, Generator, IO, Any
 from contextlib import contextmanager
 from queue import Empty as EmptyQueueException
+from queue import Queue
+from threading import Event, Lock, Thread
 import os
 import tempfile
 import json
+import time
 
 import jupyter_client
 from pynvim import Nvim
@@ -12,6 +15,7 @@ from pynvim import Nvim
 from molten.options import MoltenOptions
 from molten.outputchunks import (
     Output,
+    AbortedOutputChunk,
     MimetypesOutputChunk,
     ErrorOutputChunk,
     TextOutputChunk,
@@ -19,8 +23,14 @@ from molten.outputchunks import (
     to_outputchunk,
     clean_up_text,
 )
+from molten.retention import OutputRetention
 from molten.runtime_state import RuntimeState
 from molten.jupyter_server_api import JupyterAPIClient, JupyterAPIManager
+from molten.utils import notify_error
+
+# How long (in seconds) the iopub reader thread blocks on the kernel before it re-checks whether it
+# should stop or redo the ready handshake
+IOPUB_READER_TIMEOUT = 1
 
 
 class JupyterRuntime:
@@ -32,10 +42,37 @@ class JupyterRuntime:
     kernel_client: jupyter_client.KernelClient | JupyterAPIClient  # type: ignore
 
     allocated_files: List[str]
+    retention: OutputRetention
+    """how much of the text streamed to this kernel's outputs stays in memory"""
 
     options: MoltenOptions
     nvim: Nvim
 
+    _outputs: Dict[str, Output]
+    """Outputs of the executions that haven't finished yet, by the msg_id of their
+    execute_request. iopub messages are routed to them using their parent_header"""
+
+    messages_processed: int
+    """number of iopub messages handled by `tick`"""
+    ticks_over_budget: int
+    """number of ticks that stopped early because they hit the message or time budget"""
+    backlogged: bool
+    """whether the last tick stopped early, leaving messages for the next one"""
+
+    _iopub_reader: Optional[Thread]
+    _iopub_queue: "Queue[Dict[str, Any]]"
+    _on_iopub_message: Optional[Callable[[], None]]
+    _reader_stop: Event
+    _kernel_ready: Event
+    _wakeup_pending: Event
+    _ready_lock: Lock
+    """taken to set `_kernel_ready` on the reader thread, and to clear it after a restart, never
+    while waiting on the kernel"""
+    _restarts: int
+    """number of restarts, a handshake started before the last one was with the old kernel"""
+    _pending_requests: List[Tuple[str, Output]]
+    """code waiting for the reader thread's handshake before it's sent to the kernel"""
+
     def __init__(self, nvim: Nvim, kernel_name: str, kernel_id: str, options: MoltenOptions):
         self.state = RuntimeState.STARTING
         self.kernel_name = kernel_name
@@ -43,18 +80,40 @@ class JupyterRuntime:
         self.nvim = nvim
         self.nvim.exec_lua("_prompt_stdin = require('prompt').prompt_stdin")
 
-        if kernel_name.startswith("http://") or kernel_name.startswith("https://"):
+        self.allocated_files = []
+        self.options = options
+        self.retention = OutputRetention(options, self._alloc_file)
+
+        self._outputs = {}
+
+        self.messages_processed = 0
+        self.ticks_over_budget = 0
+        self.backlogged = False
+
+        self._iopub_reader = None
+        self._iopub_queue = Queue()
+        self._on_iopub_message = None
+        self._reader_stop = Event()
+        self._kernel_ready = Event()
+        self._wakeup_pending = Event()
+        self._ready_lock = Lock()
+        self._restarts = 0
+        self._pending_requests = []
+
+        self._start_kernel()
+
+    def _start_kernel(self) -> None:
+        if self.kernel_name.startswith("http://") or self.kernel_name.startswith("https://"):
             self.external_kernel = False
             # 从options获取SSL验证设置，默认为False（允许自签名证书）
-            verify_ssl = getattr(options, 'verify_ssl', False)
-            self.kernel_manager = JupyterAPIManager(kernel_name, verify_ssl=verify_ssl)
+            verify_ssl = getattr(self.options, 'verify_ssl', False)
+            self.kernel_manager = JupyterAPIManager(self.kernel_name, verify_ssl=verify_ssl)
             self.kernel_manager.start_kernel()
             self.kernel_client = self.kernel_manager.client()
             self.kernel_client.start_channels()
-            self.options = options
         elif ".json" not in self.kernel_name:
             self.external_kernel = False
-            self.kernel_manager = jupyter_client.manager.KernelManager(kernel_name=kernel_name)
+            self.kernel_manager = jupyter_client.manager.KernelManager(kernel_name=self.kernel_name)
             self.kernel_manager.start_kernel()
             self.kernel_client = self.kernel_manager.client()
             assert isinstance(
@@ -67,7 +126,7 @@ class JupyterRuntime:
             )
             self.kernel_client.write_connection_file()
         else:
-            kernel_file = kernel_name
+            kernel_file = self.kernel_name
             self.external_kernel = True
             # Opening JSON file
             try:
@@ -82,13 +141,12 @@ class JupyterRuntime:
             self.kernel_client = self.kernel_manager.client()
             self.kernel_client.load_connection_file(connection_file=kernel_file)
 
-        self.allocated_files = []
-        self.options = options
-
     def is_ready(self) -> bool:
         return self.state.value > RuntimeState.STARTING.value
 
     def deinit(self) -> None:
+        self._reader_stop.set()
+
         for path in self.allocated_files:
             if os.path.exists(path):
                 os.remove(path)
@@ -102,10 +160,123 @@ class JupyterRuntime:
 
     def restart(self) -> None:
         self.state = RuntimeState.STARTING
+        # the new kernel won't reply to anything we sent to the old one
+        self._outputs.clear()
+        self._pending_requests.clear()
         self.kernel_manager.restart_kernel()
+        # only once the old kernel is gone, or it could answer the reader's handshake
+        with self._ready_lock:
+            self._restarts += 1
+            self._kernel_ready.clear()
+
+    def run_code(self, code: str, output: Output) -> Optional[str]:
+        """Send code to the kernel, its output will be written to `output`. The kernel queues
+        requests itself, so this can be called again before the previous code has finished.
+        Returns: the msg_id of the execute_request, None if it waits for the kernel to be ready"""
+        if self._iopub_reader is not None and (
+            not self._kernel_ready.is_set() or self._pending_requests
+        ):
+            # the reader thread is using the shell channel for the handshake, `tick` sends it once
+            # that's done
+            self._pending_requests.append((code, output))
+            return None
+
+        msg_id = self.kernel_client.execute(code)
+        self._outputs[msg_id] = output
+        return msg_id
+
+    def _send_pending_requests(self) -> None:
+        pending, self._pending_requests = self._pending_requests, []
+        for code, output in pending:
+            msg_id = self.kernel_client.execute(code)
+            self._outputs[msg_id] = output
+
+    def start_iopub_reader(self, on_message: Callable[[], None]) -> None:
+        """Receive iopub messages on a background thread instead of polling for them on every tick.
+
+        The thread blocks on the iopub channel and queues whatever arrives for `tick` to process.
+        `on_message` is called from the reader thread when the queue goes from drained to non-empty
+        (and when the kernel becomes ready), it should schedule a tick on nvim's main loop."""
+        self._on_iopub_message = on_message
+        self._iopub_reader = Thread(target=self._read_iopub, daemon=True)
+        self._iopub_reader.start()
+
+    def _read_iopub(self) -> None:
+        failed = False
+        while not self._reader_stop.is_set():
+            try:
+                if not self._kernel_ready.is_set():
+                    # This also flushes the iopub channel, so it has to happen on this thread.
+                    # `run_code` keeps requests to itself until it's done
+                    restarts = self._restarts
+                    self.kernel_client.wait_for_ready(timeout=IOPUB_READER_TIMEOUT)
+                    with self._ready_lock:
+                        if restarts != self._restarts:
+                            # answered by the kernel that was restarted, wait for the new one
+                            continue
+                        self._kernel_ready.set()
+                    self._wake()
+                    continue
 
-    def run_code(self, code: str) -> None:
-        self.kernel_client.execute(code)
+                message = self.kernel_client.get_iopub_msg(timeout=IOPUB_READER_TIMEOUT)
+            except (EmptyQueueException, RuntimeError):
+                continue
+            except Exception as e:
+                # the channels are closed underneath us when the kernel is shut down
+                if self._reader_stop.is_set():
+                    return
+                if not failed:
+                    self._report_reader_error(e)
+                failed = True
+                self._reader_stop.wait(IOPUB_READER_TIMEOUT)
+                continue
+            failed = False
+
+            # the kernel was restarted while we were waiting, its startup messages are discarded
+            # just like wait_for_ready does when polling
+            if not self._kernel_ready.is_set():
+                continue
+
+            self._iopub_queue.put(message)
+            self._wake()
+
+    def _report_reader_error(self, e: Exception) -> None:
+        """Tell the user, from nvim's thread, that reading iopub failed. The reader keeps trying,
+        this is only called again once it has read a message since"""
+        self.nvim.async_call(
+            lambda: notify_error(
+                self.nvim, f"Kernel '{self.kernel_name}': could not read its output: {e}"
+            )
+        )
+
+    def _wake(self) -> None:
+        if not self._wakeup_pending.is_set() and self._on_iopub_message is not None:
+            self._wakeup_pending.set()
+            self._on_iopub_message()
+
+    def _poll_ready(self) -> bool:
+        """Check, without blocking, whether the kernel has become ready"""
+        if self._iopub_reader is not None:
+            # the reader thread does the ready handshake, we just pick up the result
+            return self._kernel_ready.is_set()
+
+        assert isinstance(
+            self.kernel_client,
+            (
+                jupyter_client.blocking.client.BlockingKernelClient,
+                JupyterAPIClient,
+            ),
+        )
+        try:
+            self.kernel_client.wait_for_ready(timeout=0)
+        except RuntimeError:
+            return False
+        return True
+
+    def _get_iopub_msg(self) -> Dict[str, Any]:
+        if self._iopub_reader is not None:
+            return self._iopub_queue.get_nowait()
+        return self.kernel_client.get_iopub_msg(timeout=0)
 
     @contextmanager
     def _alloc_file(
@@ -118,11 +289,11 @@ class JupyterRuntime:
 
     def _append_chunk(self, output: Output, data: Dict[str, Any], metadata: Dict[str, Any]) -> None:
         if self.options.show_mimetype_debug:
-            output.chunks.append(MimetypesOutputChunk(list(data.keys())))
+            output.append_chunk(MimetypesOutputChunk(list(data.keys())))
 
         if output.success:
             chunk = to_outputchunk(self.nvim, self._alloc_file, data, metadata, self.options)
-            output.chunks.append(chunk)
+            output.append_chunk(chunk)
             if isinstance(chunk, TextOutputChunk) and chunk.text.startswith("\r"):
                 output.merge_text_chunks()
 
@@ -137,34 +308,24 @@ class JupyterRuntime:
                     pyperclip.copy(content_ctor())
 
         if output._should_clear:
-            output.chunks.clear()
+            output.clear_chunks()
             output._should_clear = False
 
         if message_type == "execute_input":
             output.execution_count = content["execution_count"]
-            if self.external_kernel is False:
-                if output.status == OutputStatus.DONE:
-                    return False
-                if output.status == OutputStatus.HOLD:
-                    output.status = OutputStatus.RUNNING
-                    output.start_time = datetime.now()
-                elif output.status == OutputStatus.RUNNING:
-                    output.status = OutputStatus.DONE
-                else:
-                    raise ValueError("bad value for output.status: %r" % output.status)
+            output.status = OutputStatus.RUNNING
+            output.start_time = datetime.now()
             return True
         elif message_type == "status":
-            execution_state = content["execution_state"]
-            assert execution_state != "starting"
-            if execution_state == "idle":
-                self.state = RuntimeState.IDLE
+            # the kernel goes idle once it's done with the request this status is a reply to
+            if content["execution_state"] == "idle":
+                if output.status == OutputStatus.HOLD:
+                    # it never started running, the kernel aborted it (eg. an earlier cell failed)
+                    output.success = False
+                    output.append_chunk(AbortedOutputChunk())
                 output.status = OutputStatus.DONE
                 return True
-            elif execution_state == "busy":
-                self.state = RuntimeState.RUNNING
-                return True
-            else:
-                return False
+            return False
         elif message_type == "execute_reply":
             # This doesn't really give us any relevant information.
             return False
@@ -177,13 +338,14 @@ class JupyterRuntime:
             output.success = False
             chunk = ErrorOutputChunk(content["ename"], content["evalue"], content["traceback"])
             chunk.extras = content
-            output.chunks.append(chunk)
+            output.append_chunk(chunk)
 
             copy_on_demand(lambda: "\n\n".join(map(clean_up_text, content["traceback"])))
             return True
         elif message_type == "stream":
             copy_on_demand(content["text"])
-            self._append_chunk(output, {"text/plain": content["text"]}, {})
+            if output.success:
+                output.append_stream(content["name"], content["text"], self.retention)
             return True
         elif message_type == "display_data":
             # XXX: consider content['transient'], if we end up saving execution
@@ -197,49 +359,72 @@ class JupyterRuntime:
             if content["wait"]:
                 output._should_clear = True
             else:
-                output.chunks.clear()
+                output.clear_chunks()
             return True
         # TODO: message_type == 'debug'?
         else:
             return False
 
-    def tick(self, output: Optional[Output]) -> bool:
+    def tick(self) -> bool:
         did_stuff = False
 
-        assert isinstance(
-            self.kernel_client,
-            (
-                jupyter_client.blocking.client.BlockingKernelClient,
-                JupyterAPIClient,
-            ),
-        )
-
         if not self.is_ready():
-            try:
-                self.kernel_client.wait_for_ready(timeout=0)
-                self.state = RuntimeState.IDLE
-                did_stuff = True
-            except RuntimeError:
+            if not self._poll_ready():
                 return False
-
-        if output is None:
-            return did_stuff
+            self.state = RuntimeState.IDLE
+            did_stuff = True
+        if self._pending_requests and self._kernel_ready.is_set():
+            self._send_pending_requests()
+
+        # cleared before draining, anything queued from here on wakes us up again
+        self._wakeup_pending.clear()
+
+        # Drain at most `tick_max_messages` messages for at most `tick_max_time` ms, so a flood of
+        # output can't block nvim. Whatever is left is picked up by the next tick.
+        max_messages = self.options.tick_max_messages
+        deadline = None
+        if self.options.tick_max_time:
+            deadline = time.monotonic() + self.options.tick_max_time / 1000
+        count = 0
+        self.backlogged = False
 
         while True:
+            if (max_messages and count >= max_messages) or (
+                deadline is not None and time.monotonic() >= deadline
+            ):
+                self.backlogged = True
+                self.ticks_over_budget += 1
+                break
+
             try:
-                message = self.kernel_client.get_iopub_msg(timeout=0)
+                message = self._get_iopub_msg()
+            except EmptyQueueException:
+                break
+            count += 1
 
-                if "content" not in message or "msg_type" not in message:
-                    continue
+            if "content" not in message or "msg_type" not in message:
+                continue
 
-                did_stuff_now = self._tick_one(output, message["msg_type"], message["content"])
-                did_stuff = did_stuff or did_stuff_now
+            if message["msg_type"] == "status":
+                execution_state = message["content"]["execution_state"]
+                if execution_state == "idle":
+                    self.state = RuntimeState.IDLE
+                elif execution_state == "busy":
+                    self.state = RuntimeState.RUNNING
 
-                if output.status == OutputStatus.DONE:
-                    break
-            except EmptyQueueException:
-                break
+            msg_id = message.get("parent_header", {}).get("msg_id")
+            output = self._outputs.get(msg_id)
+            if output is None:
+                # not a reply to code we sent, eg. from another client of an external kernel
+                continue
 
+            did_stuff_now = self._tick_one(output, message["msg_type"], message["content"])
+            did_stuff = did_stuff or did_stuff_now
+
+            if output.status == OutputStatus.DONE:
+                del self._outputs[msg_id]
+
+        self.messages_processed += count
         return did_stuff
 
     def tick_input(self):
@@ -260,6 +445,10 @@ class JupyterRuntime:
         except EmptyQueueException:
             pass
 
+    def send_stdin(self, text: str) -> None:
+        """Reply to the kernel's pending input_request"""
+        self.kernel_client.input(text)
+
     def take_input(self, msg):
         if msg["msg_type"] == "input_request":
             self.nvim.lua._prompt_stdin(self.kernel_id, msg["content"]["prompt"])
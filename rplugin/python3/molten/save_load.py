@@ -86,7 +86,7 @@ def load(nvim: Nvim, moltenbuffer: MoltenKernel, nvim_buffer: Buffer, data: Dict
         for chunk in cell["chunks"]:
             MoltenIOError.assert_has_key(chunk, "data", dict)
             MoltenIOError.assert_has_key(chunk, "metadata", dict)
-            output.chunks.append(
+            output.append_chunk(
                 to_outputchunk(
                     nvim,
                     moltenbuffer.runtime._alloc_file,
@@ -1,5 +1,7 @@
 from pynvim import Nvim
 
+from molten.position import flush_extmark_deletions
+
 
 class MoltenException(Exception):
     pass
@@ -8,9 +10,11 @@ class MoltenException(Exception):
 def nvimui(func):  # type: ignore
     def inner(self, *args, **kwargs):  # type: ignore
         try:
-            func(self, *args, **kwargs)
+            return func(self, *args, **kwargs)
         except MoltenException as err:
             self.nvim.err_write("[Molten] " + str(err) + "\n")
+        finally:
+            flush_extmark_deletions()
 
     return inner
 
@@ -0,0 +1,73 @@
+import pytest
+
+from molten.ansi import collapse_sgr, highlight_definition, highlight_group, parse_ansi
+
+
+def groups(text):
+    plain, spans, _ = parse_ansi(text)
+    return plain, [(start, end, highlight_group(style)) for start, end, style in spans]
+
+
+@pytest.mark.parametrize(
+    "text, plain, expected",
+    [
+        ("plain", "plain", []),
+        ("\x1b[31mred\x1b[0m", "red", [(0, 3, "MoltenAnsiFg1")]),
+        ("\x1b[1;92mok\x1b[m!", "ok!", [(0, 2, "MoltenAnsiFg10Bold")]),
+        ("\x1b[44;3mx\x1b[23my", "xy", [(0, 1, "MoltenAnsiBg4Italic"), (1, 2, "MoltenAnsiBg4")]),
+        # 256 colors
+        (
+            "\x1b[38;5;208mo\x1b[48;5;17mb",
+            "ob",
+            [(0, 1, "MoltenAnsiFg208"), (1, 2, "MoltenAnsiFg208Bg17")],
+        ),
+        # 24 bit colors, clamped to 255
+        ("\x1b[38;2;255;128;0mt\x1b[39mu", "tu", [(0, 1, "MoltenAnsiFgff8000")]),
+        ("\x1b[48;2;300;0;16mt", "t", [(0, 1, "MoltenAnsiBgff0010")]),
+        # resets of a single attribute, and of everything
+        (
+            "\x1b[4;9;7mx\x1b[24;29my\x1b[27mz",
+            "xyz",
+            [(0, 1, "MoltenAnsiUnderlineStrikethroughReverse"), (1, 2, "MoltenAnsiReverse")],
+        ),
+        ("\x1b[31;1mx\x1b[0;32my", "xy", [(0, 1, "MoltenAnsiFg1Bold"), (1, 2, "MoltenAnsiFg2")]),
+        # unknown and malformed parameters are ignored
+        ("\x1b[5;31mx", "x", [(0, 1, "MoltenAnsiFg1")]),
+        ("\x1b[38;5mx", "x", []),
+        ("\x1b[31:1mx", "x", []),
+        # sequences that aren't SGR are removed without changing the style
+        ("\x1b[31ma\x1b[2Kb", "ab", [(0, 2, "MoltenAnsiFg1")]),
+    ],
+)
+def test_parse_ansi(text, plain, expected):
+    assert groups(text) == (plain, expected)
+
+
+def test_style_carries_over_between_texts():
+    _, _, style = parse_ansi("\x1b[33mstart")
+    assert parse_ansi("next", style) == ("next", [(0, 4, style)], style)
+
+
+@pytest.mark.parametrize(
+    "text, collapsed",
+    [
+        ("no escapes", ""),
+        ("\x1b[31mred", "\x1b[31m"),
+        ("\x1b[31m\x1b[1m\x1b[22m", "\x1b[31;22m"),
+        ("\x1b[38;5;208m\x1b[48;2;1;2;3m", "\x1b[38;5;208;48;2;1;2;3m"),
+        ("\x1b[0m", "\x1b[39;49;22;23;24;29;27m"),
+        ("\x1b[2Kprogress", ""),
+    ],
+)
+def test_collapse_sgr(text, collapsed):
+    assert collapse_sgr(text) == collapsed
+
+
+def test_palette_colors_keep_their_cterm_index():
+    _, spans, _ = parse_ansi("\x1b[38;5;196;48;5;244mx")
+    assert highlight_definition(spans[0][2]) == {
+        "fg": "#ff0000",
+        "ctermfg": 196,
+        "bg": "#808080",
+        "ctermbg": 244,
+    }
@@ -0,0 +1,43 @@
+import asyncio
+import threading
+import time
+from threading import Event
+
+from molten.async_runtime import AsyncJupyterRuntime, KernelLoop
+from molten.runtime_state import RuntimeState
+
+
+def test_restart_is_ready_only_for_the_new_kernel():
+    runtime = AsyncJupyterRuntime.__new__(AsyncJupyterRuntime)
+    runtime._loop = KernelLoop.get()
+    runtime._kernel_ready = Event()
+    runtime._kernel_ready.set()
+    runtime._restarting = Event()
+    runtime._outputs = {"old": None}
+    runtime._accepting_requests = asyncio.Event()
+    runtime._loop.call_soon(runtime._accepting_requests.set)
+    may_finish = threading.Event()
+    seen = []
+
+    class KernelManager:
+        async def restart_kernel(self):
+            seen.append((runtime._kernel_ready.is_set(), runtime._accepting_requests.is_set()))
+            await asyncio.get_running_loop().run_in_executor(None, may_finish.wait)
+
+    runtime.kernel_manager = KernelManager()
+    runtime.restart()
+
+    # the old kernel's ready state doesn't count while it restarts
+    assert runtime.state == RuntimeState.STARTING
+    assert runtime._outputs == {}
+    assert not runtime._poll_ready()
+
+    may_finish.set()
+    for _ in range(500):
+        if not runtime._restarting.is_set():
+            break
+        time.sleep(0.01)
+    assert seen == [(True, False)]
+    assert not runtime._restarting.is_set()
+    assert not runtime._kernel_ready.is_set()
+    assert not runtime._poll_ready()
@@ -0,0 +1,95 @@
+from molten.cell_index import CellMap, SpanIndex
+from molten.code_cell import CodeCell
+from molten.position import Position, position_snapshot
+
+
+class FakeApi:
+    def __init__(self):
+        self.changedtick = 1
+        self.calls = 0
+
+    def buf_get_changedtick(self, bufno):
+        self.calls += 1
+        return self.changedtick
+
+
+class FakeNvim:
+    def __init__(self):
+        self.api = FakeApi()
+
+
+class Kernel:
+    def __init__(self, span_index):
+        self.outputs = CellMap(lambda cell, added: span_index.cell_changed(cell, self, added))
+
+
+def cell(begin, end):
+    return CodeCell(None, Position(0, begin, 0), Position(0, end, 0))
+
+
+def make_index():
+    nvim = FakeNvim()
+    kernels = []
+    span_index = SpanIndex(nvim, lambda bufno: kernels)
+    kernels.extend([Kernel(span_index), Kernel(span_index)])
+    return nvim, span_index, kernels
+
+
+def test_inserted_cells_are_found_without_a_rebuild():
+    _, span_index, (a, b) = make_index()
+    first = cell(0, 10)
+    a.outputs[first] = None
+    index = span_index.get(0)
+
+    second = cell(20, 30)
+    inner = cell(2, 4)
+    b.outputs[second] = None
+    a.outputs[inner] = None
+
+    assert span_index.get(0) is index
+    assert index.find(Position(0, 25, 0)) is second
+    assert index.find(Position(0, 25, 0), owner=a) is None
+    assert index.find(Position(0, 3, 0)) is inner
+    # the long cell before the inner one still contains what comes after it
+    assert index.find(Position(0, 6, 0)) is first
+    assert index.overlapping(cell(5, 22)) == [(first, a), (second, b)]
+
+
+def test_removed_cells_are_gone_without_a_rebuild():
+    _, span_index, (a, b) = make_index()
+    long = cell(0, 50)
+    short = cell(10, 20)
+    last = cell(30, 40)
+    a.outputs[long] = None
+    a.outputs[short] = None
+    b.outputs[last] = None
+    index = span_index.get(0)
+
+    del a.outputs[long]
+    assert index.find(Position(0, 25, 0)) is None
+    assert index.find(Position(0, 15, 0)) is short
+    b.outputs.pop(last)
+    assert index.overlapping(cell(0, 50)) == [(short, a)]
+    a.outputs.clear()
+    assert index.overlapping(cell(0, 50)) == []
+    assert span_index.get(0) is index
+
+
+def test_index_is_rebuilt_once_the_buffer_changes():
+    nvim, span_index, (a, _) = make_index()
+    a.outputs[cell(0, 10)] = None
+    index = span_index.get(0)
+
+    nvim.api.changedtick += 1
+    rebuilt = span_index.get(0)
+    assert rebuilt is not index
+    assert rebuilt.find(Position(0, 5, 0)) is not None
+
+
+def test_changedtick_is_read_once_per_snapshot():
+    nvim, span_index, (a, _) = make_index()
+    a.outputs[cell(0, 10)] = None
+    with position_snapshot():
+        span_index.get(0)
+        span_index.get(0)
+    assert nvim.api.calls == 1
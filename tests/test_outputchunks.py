@@ -0,0 +1,85 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from molten.outputchunks import Output, OutputText, StreamOutputChunk, TextLnOutputChunk
+
+
+def stream(*messages: str) -> StreamOutputChunk:
+    chunk = StreamOutputChunk("stdout", messages[0])
+    for message in messages[1:]:
+        chunk.append(message)
+    return chunk
+
+
+def test_carriage_return_rewinds_the_line():
+    assert stream("progress 10%\r", "progress 20%\n").jupyter_data["text/plain"] == (
+        "progress 20%\n"
+    )
+
+
+def test_escape_sequence_after_carriage_return_keeps_the_line():
+    assert stream("x\r", "\x1b[0m\n").jupyter_data["text/plain"] == "x\x1b[0m\n"
+
+
+def test_carriage_return_stays_pending_after_escape_sequence():
+    chunk = stream("x\r", "\x1b[m")
+    assert chunk.jupyter_data["text/plain"] == "x\x1b[m"
+    chunk.append("y")
+    assert chunk.jupyter_data["text/plain"] == "\x1b[my"
+
+
+def test_split_carriage_return_new_line():
+    assert stream("x\r", "\ny").jupyter_data["text/plain"] == "x\ny"
+
+
+def test_saved_text_has_no_pending_carriage_return():
+    chunk = stream("50%\r")
+    assert chunk.jupyter_data["text/plain"] == "50%"
+    assert chunk.text == "50%\n"
+
+
+def test_stream_is_parsed_once_until_text_is_appended():
+    chunk = stream("a\n", "b")
+    assert chunk.text is chunk.text
+    parsed = chunk.parsed()
+    assert chunk.parsed()[0] is parsed[0]
+    chunk.append("c\n")
+    assert chunk.parsed()[0] == "a\nbc\n"
+
+
+def build(output_text, output, options, width, virtual):
+    lines, extra_lines = output_text.build(output, 0, options, (0, 0, width, 10), None, virtual)
+    return lines, extra_lines, output_text.lines_total
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_incremental_layout_matches_a_fresh_one(seed):
+    rng = random.Random(seed)
+    options = SimpleNamespace(
+        limit_output_chars=rng.choice([0, 50, 200, 1000]),
+        wrap_output=rng.choice([True, False]),
+        image_location="both",
+    )
+    width = rng.choice([10, 20, 80])
+    virtual = rng.choice([True, False])
+    output = Output(None)
+    incremental = OutputText()
+
+    for _ in range(rng.randint(1, 30)):
+        if rng.random() < 0.7:
+            text = "".join(
+                "x" * rng.randint(0, 40) + ("\n" if rng.random() < 0.6 else "")
+                for _ in range(rng.randint(0, 4))
+            )
+            if rng.random() < 0.2:
+                text = "\x1b[31m" + text + "\x1b[0m"
+            output.append_stream(rng.choice(["stdout", "stderr"]), text)
+        else:
+            output.append_chunk(TextLnOutputChunk("y" * rng.randint(0, 50)))
+        # however the text was split between renders
+        if rng.random() < 0.5:
+            assert build(incremental, output, options, width, virtual) == build(
+                OutputText(), output, options, width, virtual
+            )
@@ -0,0 +1,100 @@
+import os
+import random
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from molten.outputchunks import StreamOutputChunk
+from molten.retention import INDEX_INTERVAL, OutputRetention, SpillFile
+
+
+def make_retention(tmp_path, per_cell, per_kernel):
+    count = iter(range(1000000))
+
+    @contextmanager
+    def alloc_file(extension, mode):
+        path = str(tmp_path / f"{next(count)}.{extension}")
+        with open(path, mode) as file:
+            yield path, file
+
+    options = SimpleNamespace(output_memory_per_cell=per_cell, output_memory_per_kernel=per_kernel)
+    return OutputRetention(options, alloc_file)
+
+
+def test_kernel_budget_bounds_the_heads_too(tmp_path):
+    retention = make_retention(tmp_path, per_cell=1000, per_kernel=2000)
+    lines = [f"{cell} line {i}" for cell in range(10) for i in range(100)]
+    chunks = [StreamOutputChunk("stdout", "", retention) for _ in range(10)]
+    for line in lines:
+        chunks[int(line.split()[0])].append(line + "\n")
+
+    assert retention.used <= 2000
+    assert sum(chunk.head_size + chunk.tail_size for chunk in chunks) == retention.used
+    # nothing is lost, it's read back from the spill files
+    for cell, chunk in enumerate(chunks):
+        expected = [line for line in lines if line.startswith(f"{cell} ")]
+        assert chunk.get_lines(0, chunk.line_count) == expected
+
+
+def test_over_budget_spills_down_to_the_low_water_mark(tmp_path):
+    retention = make_retention(tmp_path, per_cell=0, per_kernel=1000)
+    chunk = StreamOutputChunk("stdout", "", retention)
+    for _ in range(100):
+        chunk.append("x" * 9 + "\n")
+    assert retention.used == 1000
+
+    chunk.append("x" * 9 + "\n")
+    assert retention.used <= 750
+    used = retention.used
+    # under the budget again, the next lines don't spill anything
+    chunk.append("x" * 9 + "\n")
+    assert retention.used == used + 10
+
+
+def make_spill(tmp_path):
+    return SpillFile(make_retention(tmp_path, 0, 0).alloc_file)
+
+
+def test_spill_file_reads_lines_back_across_index_blocks(tmp_path):
+    spill = make_spill(tmp_path)
+    lines = [f"line {i} " + "é" * (i % 7) for i in range(INDEX_INTERVAL * 5 + 3)]
+    # appended in uneven pieces, so the indexed lines fall in the middle of them
+    for start in range(0, len(lines), 50):
+        spill.append(lines[start : start + 50])
+
+    assert len(spill) == len(lines)
+    assert len(spill.offsets) == 6
+    assert spill.read(0, len(lines)) == lines
+    rng = random.Random(0)
+    for _ in range(200):
+        start = rng.randrange(len(lines))
+        end = rng.randrange(start, len(lines) + 10)
+        assert spill.read(start, end) == lines[start:end]
+    assert spill.read(len(lines), len(lines) + 5) == []
+
+
+def test_spill_file_sees_lines_appended_after_it_was_read(tmp_path):
+    spill = make_spill(tmp_path)
+    spill.append(["a", "b"])
+    assert spill.read(0, 2) == ["a", "b"]
+    spill.append(["c"] * INDEX_INTERVAL)
+    assert spill.read(1, INDEX_INTERVAL + 2) == ["b"] + ["c"] * INDEX_INTERVAL
+
+
+def test_spill_file_is_removed(tmp_path):
+    spill = make_spill(tmp_path)
+    spill.append(["a"])
+    spill.read(0, 1)
+    spill.remove()
+    assert not os.path.exists(spill.path)
+    assert spill._map is None
+    # removing it twice is fine, eg. from a chunk's __del__
+    spill.remove()
+
+
+def test_spilled_chunk_removes_its_file(tmp_path):
+    retention = make_retention(tmp_path, per_cell=20, per_kernel=0)
+    chunk = StreamOutputChunk("stdout", "line\n" * 100, retention)
+    path = chunk.spill.path
+    assert os.path.exists(path)
+    del chunk
+    assert not os.path.exists(path)
@@ -0,0 +1,165 @@
+from queue import Empty, Queue
+from threading import Event, Lock
+from types import SimpleNamespace
+
+import molten.runtime
+from molten.outputchunks import Output, OutputStatus
+from molten.runtime import JupyterRuntime
+from molten.runtime_state import RuntimeState
+
+
+class FakeNvim:
+    def __init__(self):
+        self.calls = []
+
+    def async_call(self, fn):
+        self.calls.append(fn)
+
+
+def make_runtime(client=None):
+    runtime = JupyterRuntime.__new__(JupyterRuntime)
+    runtime.nvim = FakeNvim()
+    runtime.kernel_name = "python3"
+    runtime.kernel_client = client
+    runtime.options = SimpleNamespace(tick_max_messages=0, tick_max_time=0)
+    runtime.state = RuntimeState.STARTING
+    runtime.messages_processed = 0
+    runtime.ticks_over_budget = 0
+    runtime.backlogged = False
+    runtime._outputs = {}
+    runtime._iopub_reader = None
+    runtime._iopub_queue = Queue()
+    runtime._on_iopub_message = None
+    runtime._reader_stop = Event()
+    runtime._kernel_ready = Event()
+    runtime._wakeup_pending = Event()
+    runtime._ready_lock = Lock()
+    runtime._restarts = 0
+    runtime._pending_requests = []
+    return runtime
+
+
+def test_restart_clears_ready_only_once_the_kernel_restarted():
+    runtime = make_runtime()
+    runtime._kernel_ready.set()
+    runtime._outputs = {"old": None}
+    runtime._pending_requests = [("1", None)]
+    seen = []
+
+    class KernelManager:
+        def restart_kernel(self):
+            # the reader can't start a handshake with the old kernel while it's going away
+            seen.append(runtime._kernel_ready.is_set())
+
+    runtime.kernel_manager = KernelManager()
+    runtime.restart()
+
+    assert seen == [True]
+    assert not runtime._kernel_ready.is_set()
+    assert runtime._outputs == {}
+    assert runtime._pending_requests == []
+    assert runtime.state == RuntimeState.STARTING
+
+
+def test_handshake_with_the_restarted_kernel_is_discarded():
+    handshakes = []
+
+    class Client:
+        def wait_for_ready(self, timeout):
+            handshakes.append(timeout)
+            if len(handshakes) == 1:
+                # nvim's thread restarts the kernel while the old one answers
+                runtime.restart()
+            else:
+                runtime._reader_stop.set()
+
+    runtime = make_runtime(Client())
+    runtime.kernel_manager = SimpleNamespace(restart_kernel=lambda: None)
+    runtime._read_iopub()
+
+    assert len(handshakes) == 2
+    assert runtime._kernel_ready.is_set()
+
+
+def test_run_code_waits_for_the_handshake():
+    sent = []
+    client = SimpleNamespace(execute=lambda code: sent.append(code) or f"msg-{len(sent)}")
+    runtime = make_runtime(client)
+    runtime._iopub_reader = object()
+    first, second = object(), object()
+
+    # the reader thread is using the shell channel, nothing is sent and nothing blocks
+    assert runtime.run_code("1", first) is None
+    runtime._kernel_ready.set()
+    # queued behind the first one until the tick sends them in order
+    assert runtime.run_code("2", second) is None
+    assert sent == []
+
+    runtime.tick()
+    assert sent == ["1", "2"]
+    assert runtime._outputs == {"msg-1": first, "msg-2": second}
+    assert runtime.run_code("3", first) == "msg-3"
+
+
+def test_reader_reports_errors_and_keeps_reading(monkeypatch):
+    monkeypatch.setattr(molten.runtime, "IOPUB_READER_TIMEOUT", 0)
+    replies = [OSError("socket closed"), OSError("socket closed"), {"msg_type": "status"}]
+
+    class Client:
+        def get_iopub_msg(self, timeout):
+            if not replies:
+                runtime._reader_stop.set()
+                raise Empty()
+            reply = replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+    runtime = make_runtime(Client())
+    runtime._kernel_ready.set()
+    runtime._read_iopub()
+
+    # reported once, not once per failed read
+    assert len(runtime.nvim.calls) == 1
+    assert runtime._iopub_queue.get_nowait() == {"msg_type": "status"}
+
+
+def message(msg_id, msg_type, **content):
+    return {"parent_header": {"msg_id": msg_id}, "msg_type": msg_type, "content": content}
+
+
+def test_messages_are_routed_to_the_output_of_their_request():
+    runtime = make_runtime()
+    runtime.options = SimpleNamespace(
+        tick_max_messages=0, tick_max_time=0, show_mimetype_debug=False, copy_output=False
+    )
+    runtime.retention = None
+    runtime.state = RuntimeState.IDLE
+    runtime._iopub_reader = object()
+    first, second = Output(None), Output(None)
+    runtime._outputs = {"a": first, "b": second}
+
+    for msg in [
+        message("a", "status", execution_state="busy"),
+        message("a", "execute_input", execution_count=1, code=""),
+        message("b", "status", execution_state="busy"),
+        message("b", "execute_input", execution_count=2, code=""),
+        message("a", "stream", name="stdout", text="from a\n"),
+        # another client of an external kernel
+        message("c", "stream", name="stdout", text="from c\n"),
+        message("b", "stream", name="stdout", text="from b\n"),
+        message("a", "status", execution_state="idle"),
+        message("b", "stream", name="stdout", text="b again\n"),
+    ]:
+        runtime._iopub_queue.put(msg)
+    runtime.tick()
+
+    assert first.execution_count == 1
+    assert [chunk.text for chunk in first.chunks] == ["from a\n"]
+    assert first.status == OutputStatus.DONE
+    assert second.execution_count == 2
+    assert [chunk.text for chunk in second.chunks] == ["from b\nb again\n"]
+    assert second.status == OutputStatus.RUNNING
+    # finished requests are forgotten, the one still running isn't
+    assert runtime._outputs == {"b": second}
+    assert runtime.messages_processed == 9
@@ -0,0 +1,100 @@
+from queue import Queue
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+
+from molten import Molten
+from molten.moltenbuffer import MoltenKernel
+from molten.runtime import JupyterRuntime
+from molten.runtime_state import RuntimeState
+
+
+class FakeFuncs:
+    def __init__(self):
+        self.started = []
+
+    def timer_start(self, delay, name):
+        self.started.append((delay, name))
+        return len(self.started)
+
+    def timer_stop(self, timer):
+        pass
+
+
+class FailingKernel:
+    next_tick = 0
+
+    def tick(self):
+        raise RuntimeError("kernel went away")
+
+
+def test_tick_is_rescheduled_when_a_kernel_fails():
+    molten = Molten.__new__(Molten)
+    molten.nvim = SimpleNamespace(funcs=FakeFuncs())
+    molten.options = SimpleNamespace(
+        adaptive_tick=True, iopub_delivery="poll", async_runtime=False, tick_rate_max=2000
+    )
+    molten.initialized = True
+    molten.timer = None
+    molten.molten_kernels = {"python3": FailingKernel()}
+
+    with pytest.raises(RuntimeError):
+        molten.function_molten_tick([])
+
+    assert molten.nvim.funcs.started == [(0, "MoltenTick")]
+
+
+def backlogged_kernel(messages):
+    runtime = JupyterRuntime.__new__(JupyterRuntime)
+    runtime.options = SimpleNamespace(tick_max_messages=3, tick_max_time=0)
+    runtime.state = RuntimeState.IDLE
+    runtime.messages_processed = 0
+    runtime.ticks_over_budget = 0
+    runtime.backlogged = False
+    runtime._outputs = {}
+    runtime._iopub_reader = object()
+    runtime._iopub_queue = Queue()
+    runtime._kernel_ready = Event()
+    runtime._kernel_ready.set()
+    runtime._wakeup_pending = Event()
+    runtime._pending_requests = []
+    for _ in range(messages):
+        # replies to another client, nothing to show
+        runtime._iopub_queue.put(
+            {"parent_header": {"msg_id": "other"}, "msg_type": "stream", "content": {}}
+        )
+
+    kernel = MoltenKernel.__new__(MoltenKernel)
+    kernel.runtime = runtime
+    kernel.options = SimpleNamespace(
+        output_show_exec_time=False, tick_rate_min=50, tick_rate_max=2000
+    )
+    kernel.running_cells = []
+    kernel.tick_delay = 50
+    kernel.requested = 0
+
+    def request_tick():
+        kernel.requested += 1
+
+    kernel._request_tick = request_tick
+    return kernel
+
+
+def test_tick_stops_at_its_budget_and_asks_for_another():
+    kernel = backlogged_kernel(7)
+
+    kernel.tick()
+    assert kernel.runtime.backlogged
+    assert kernel.runtime.ticks_over_budget == 1
+    assert kernel.runtime.messages_processed == 3
+    assert kernel.requested == 1
+
+    kernel.tick()
+    kernel.tick()
+    # the last one drains the rest, and doesn't ask again
+    assert not kernel.runtime.backlogged
+    assert kernel.runtime.ticks_over_budget == 2
+    assert kernel.runtime.messages_processed == 7
+    assert kernel.runtime._iopub_queue.empty()
+    assert kernel.requested == 2
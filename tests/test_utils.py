@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+import molten.utils
+from molten.utils import MoltenException, nvimui
+
+
+class Handler:
+    def __init__(self):
+        self.nvim = SimpleNamespace(err_write=lambda message: None)
+
+    @nvimui
+    def kernels(self):
+        return ["python3"]
+
+    @nvimui
+    def fail(self):
+        raise MoltenException("no kernel")
+
+
+def test_handlers_flush_extmark_deletions_and_keep_their_result(monkeypatch):
+    flushes = []
+    monkeypatch.setattr(molten.utils, "flush_extmark_deletions", lambda: flushes.append(True))
+    handler = Handler()
+
+    assert handler.kernels() == ["python3"]
+    assert handler.fail() is None
+    assert len(flushes) == 2